@@ -1,2 +1,3 @@
 from .model_api import Model
 from .maskrcnn_api import MaskRCNNModel
+from .resolution import ResolutionPolicy
@@ -4,20 +4,39 @@
 """
 
 import os
+import json
+import hashlib
 from shutil import copyfile
+from itertools import islice
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import skimage.io
 
 from . import Model
-from ..imutils import post_process
+from ..imutils import decode_image, image_shape, resize_mask, mask_to_polygons, instance_layers, composite
 
 # Import Mask RCNN
-import visualize
+import utils
 import model as modellib
 
+# The formats in which masks can be encoded by encode_result. Each encodes the
+# crop of a mask to its box (y1, x1, y2, x2), in an image of (height, width) shape.
+MASK_ENCODERS = {
+    "rle": lambda crop, box, shape: utils.rle_encode_crop(crop, box, shape),
+    "polygon": lambda crop, box, shape: mask_to_polygons(crop, offset=box[:2]),
+}
+
+# The detection result of a single image from MaskRCNNModel.detect_stream.
+# source is the filepath or array it was loaded from, and shape the (height, width)
+# of the original image, which differs from that of image if it was reduced.
+Detection = namedtuple("Detection", ["source", "image", "shape", "result"])
+
 class MaskRCNNModel(Model):
     """Base implementation for MaskRCNN based models"""
-    def __init__(self, name, config, model_dir, class_names):
+    def __init__(self, name, config, model_dir, class_names, frozen_graph=None, cascade=False,
+                 resolution_policy=None):
         """Initialize the Coco Model
 
         Arguments
@@ -25,31 +44,250 @@ class MaskRCNNModel(Model):
         items: list-like
             Only items from this list will be annotated, and the rest will be discarded.
             If not provided, all masks are generated.
+
+        frozen_graph: str, optional
+            The path of a graph exported with export_frozen_graph. If provided, it is run
+            instead of building the model, and there are no weights to load.
+
+        cascade: bool, default=False
+            Whether to detect images at CASCADE_MAX_DIM first, and at full resolution
+            only when the detections call for it, see MaskRCNN.detect_cascade
+
+        resolution_policy: ResolutionPolicy, optional
+            If provided, each image is detected at the resolution (longest side) that it
+            picks for it. Meant for the "pad64" resize mode, so that the molded images
+            have the shape of their content.
         """
         super().__init__(name)
+        if cascade and resolution_policy:
+            raise ValueError("cascade and resolution_policy both pick the resolution of detection, use one of them")
 
-        # Create model object in inference mode.
-        self.model = modellib.MaskRCNN(
-            mode="inference",
-            model_dir=model_dir,
-            config=config
-        )
+        if frozen_graph:
+            self.model = modellib.FrozenMaskRCNN(config, frozen_graph)
+        else:
+            # Create model object in inference mode.
+            self.model = modellib.MaskRCNN(
+                mode="inference",
+                model_dir=model_dir,
+                config=config
+            )
 
         self.class_names = class_names
+        self.frozen_graph = frozen_graph
+        self.cascade = cascade
+        self.resolution_policy = resolution_policy
+        self.weights_path = frozen_graph
 
     def load(self, filepath=None):
+        if self.frozen_graph:
+            # The weights are part of the graph
+            return
         self.model.load_weights(filepath, by_name=True)
+        self.weights_path = filepath
+
+    def export_frozen_graph(self, filepath):
+        """Write the model, along with its loaded weights, to a frozen graph
+
+        The graph starts up much faster than the model (see the frozen_graph argument
+        of __init__), but only runs with the batch size that it was exported with.
+        """
+        self.model.export_frozen_graph(filepath)
+
+    def fingerprint(self):
+        """A digest of everything besides the input image that determines the outputs
+
+        This covers the loaded weights, the configuration and the class names.
+        """
+        digest = hashlib.sha256()
+        # The weights are either a file, or a weight store directory
+        if os.path.isdir(self.weights_path):
+            filepaths = [os.path.join(self.weights_path, name) for name in sorted(os.listdir(self.weights_path))]
+        else:
+            filepaths = [self.weights_path]
+        for filepath in filepaths:
+            with open(filepath, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+
+        config = self.model.config
+        # The batch size and the threading profile have no effect on the detections of an image
+        ignored = {"BATCH_SIZE", "IMAGES_PER_GPU", "INTRA_OP_THREADS", "INTER_OP_THREADS", "CPU_AFFINITY"}
+        settings = sorted((a, repr(getattr(config, a))) for a in dir(config)
+                          if not a.startswith("__") and a not in ignored and not callable(getattr(config, a)))
+        digest.update(repr(settings).encode())
+        digest.update(repr(self.class_names).encode())
+        digest.update(repr(self.cascade).encode())
+        digest.update(repr(self.resolution_policy).encode())
+
+        return digest.hexdigest()
+
+    @property
+    def batch_size(self):
+        """The number of images the underlying model detects on at once"""
+        return self.model.config.BATCH_SIZE
+
+    @property
+    def decode_max_dim(self):
+        """The longest side that images can be shrunk to before detection without losing detail
+
+        In "square" and "pad64" mode images are scaled down to IMAGE_MAX_DIM anyway,
+        so there is no point in decoding them at a higher resolution. In the other
+        modes images are used at their full size, and this is None.
+        """
+        config = self.model.config
+        if config.IMAGE_RESIZE_MODE not in ["square", "pad64"]:
+            return None
+        return config.IMAGE_MAX_DIM
+
+    def read_image(self, data, reduced=False):
+        """Decode an image for detection
+
+            Arguments
+            ---------
+            data: bytes
+                The encoded image, e.g. the contents of a JPG file
+
+            reduced: bool, default=False
+                Whether to decode JPEGs at a reduced size, no smaller than decode_max_dim.
+                The detection results for the image are then in the reduced coordinates.
+                encode_result maps them back, given the shape of the image at full size.
+
+            Return
+            ------
+            The decoded image, and the (height, width) of the image at full size
+        """
+        max_dim = self.decode_max_dim if reduced else None
+        return decode_image(data, max_dim), image_shape(data)
+
+    def detect(self, images, verbose=0, timings=None, sparse_masks=False):
+        """Run detection on any number of images
+
+        The underlying model accepts batches of up to `batch_size` images, so
+        the images are split into batches of that size. With cascade, each batch
+        goes through MaskRCNN.detect_cascade instead. With resolution_policy,
+        images are batched with the ones that it picks the same resolution and
+        molded shape for.
+
+        Arguments
+        ---------
+        images: list[np.ndarray]
+            The images to run detection on
+
+        timings: dict, optional
+            If provided, the time spent in each step of detection is added to it,
+            see MaskRCNN.detect
+
+        sparse_masks: bool, default=False
+            Whether to return the masks as SparseMasks, which only hold the mask
+            of each instance within its box, see MaskRCNN.detect
+
+        Return
+        ------
+        A list of result dicts, one per image, as returned by MaskRCNN.detect
+        """
+        if self.resolution_policy:
+            return self._detect_adaptive(images, verbose, timings, sparse_masks)
+
+        detect = self.model.detect_cascade if self.cascade else self.model.detect
+        results = []
+        for i in range(0, len(images), self.batch_size):
+            batch = list(images[i:i + self.batch_size])
+            results.extend(detect(batch, verbose=verbose, timings=timings, sparse_masks=sparse_masks))
+
+        return results
+
+    def _detect_adaptive(self, images, verbose=0, timings=None, sparse_masks=False):
+        """Detect each image at the resolution that resolution_policy picks for it
+
+        A batch is molded to a single shape, so the images are grouped by their
+        resolution and molded shape, and batched within the groups.
+        """
+        groups = OrderedDict()
+        for i, image in enumerate(images):
+            max_dim = self.resolution_policy(image)
+            molded_shape = self.model.mold_layout(image.shape, max_dim)[3]
+            groups.setdefault((max_dim, molded_shape), []).append(i)
+
+        results = [None] * len(images)
+        for (max_dim, _), indices in groups.items():
+            for i in range(0, len(indices), self.batch_size):
+                batch = indices[i:i + self.batch_size]
+                detections = self.model.detect([images[j] for j in batch], verbose=verbose, timings=timings,
+                                               sparse_masks=sparse_masks, max_dim=max_dim)
+                for j, result in zip(batch, detections):
+                    results[j] = result
+
+        return results
 
     def create_mask(self, filepath, output_dir, generate_per_class=False):
         return self.create_masks([filepath], output_dir, generate_per_class)
 
-    def create_masks(self, filepaths, output_dir, generate_per_class=False):
+    def detect_stream(self, images, verbose=0, timings=None, reduced=False, sparse_masks=False):
+        """Run detection on a stream of images of any length, one batch at a time
+
+        Images are loaded a batch at a time, and the next batch is loaded in the
+        background while detection runs on the current one. Only two batches are
+        in memory at once, however long the stream is.
+
+        Arguments
+        ---------
+        images: iterable
+            Filepaths of images, or images as np.ndarray
+
+        timings: dict, optional
+            If provided, the time spent in each step of detection is added to it
+
+        reduced: bool, default=False
+            Whether to decode the images from filepaths at a reduced size, see read_image
+
+        sparse_masks: bool, default=False
+            Whether to return the masks as SparseMasks, see detect
+
+        Return
+        ------
+        A generator of Detection, one per image, in order
+        """
+        images = iter(images)
+
+        def load_batch():
+            return [(source, ) + self._load_image(source, reduced) for source in islice(images, self.batch_size)]
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_batch = executor.submit(load_batch)
+            while True:
+                batch = next_batch.result()
+                if not batch:
+                    return
+                next_batch = executor.submit(load_batch)
+
+                results = self.detect([image for _, image, _ in batch], verbose=verbose, timings=timings,
+                                      sparse_masks=sparse_masks)
+                for (source, image, shape), result in zip(batch, results):
+                    yield Detection(source, image, shape, result)
+
+    def create_masks(self, filepaths, output_dir, generate_per_class=False, mask_format=None, reduced=False):
         """Create and persist masks for each image from the filepaths
 
+            See iter_masks for the arguments.
+
+            Return
+            ------
+            The list of filepaths that were written
+        """
+        output_paths = []
+        for paths in self.iter_masks(filepaths, output_dir, generate_per_class, mask_format, reduced):
+            output_paths.extend(paths)
+
+        return output_paths
+
+    def iter_masks(self, filepaths, output_dir, generate_per_class=False, mask_format=None, reduced=False):
+        """Create and persist masks for each image from the filepaths, as they are detected
+
             Arguments
             ---------
             filepaths: iterable[str]
-                An iterable of path-like objects or strings representing filepaths
+                An iterable of path-like objects or strings representing filepaths,
+                of any length
 
             output_dir: str, path-like
                 The output directory to which the masks will be written
@@ -59,55 +297,193 @@ class MaskRCNNModel(Model):
                 Thus if there are k classes, k + 1 images will be generated:
                     1 for each class (k)
                     1 with all classes
-        """
-        images = [skimage.io.imread(filepath) for filepath in filepaths]
 
+            mask_format: str, optional
+                If provided, the detections are written as JSON, with the masks
+                encoded in this format (see encode_result), and nothing is rendered.
+                generate_per_class is ignored in this case.
+
+            reduced: bool, default=False
+                Whether to decode the images at the reduced size that the model
+                needs (see read_image). The JSON outputs are still in the
+                coordinates of the original images, the rendered masks are at
+                the reduced size.
+
+            Return
+            ------
+            A generator of lists of the filepaths written for each image, in order
+        """
         os.makedirs(output_dir + "/og", exist_ok=True)
-        originals = [output_dir + "/og/" + os.path.basename(f) for f in filepaths]
-        for src, dest in zip(filepaths, originals):
-            copyfile(src, os.path.abspath(dest))
 
-        # Run detection
-        results = self.model.detect(images, verbose=1)
+        for detection in self.detect_stream(filepaths, verbose=1, reduced=reduced, sparse_masks=True):
+            filepath = detection.source
+            original = output_dir + "/og/" + os.path.basename(filepath)
+            copyfile(filepath, os.path.abspath(original))
 
-        output_paths = originals
+            output_paths = [original]
+            if mask_format:
+                output_paths.append(self.save_result(filepath, detection.result, output_dir, mask_format, detection.shape))
+            else:
+                output_paths.extend(self.save_masks(filepath, detection.image, detection.result, output_dir, generate_per_class))
 
-        # Visualize results
-        for r, image, filepath in zip(results, images, filepaths):
-            file_basename = os.path.basename(filepath)
+            yield output_paths
 
-            class_ids = ['all']
-            if generate_per_class:
-                class_ids.extend(set(r['class_ids']))
+    def save_masks(self, filepath, image, result, output_dir, generate_per_class=False):
+        """Render and persist the masks from the detection result of a single image
 
-            class_ids = set(class_ids)
+            Arguments
+            ---------
+            filepath: str, path-like
+                The filepath of the image, whose basename is used for the outputs
+
+            image: np.ndarray
+                The image that the detection was run on
 
-            for class_id in class_ids:
-                res = self._filter_for_class_id(r, class_id)
-                output_path = output_dir + "/" + str(class_id) + "/" + file_basename
-                self._save_masks(image, res, output_path)
-                output_paths.append(output_path)
+            result: dict
+                The detection result for the image, as returned by detect
+
+            output_dir: str, path-like
+                The output directory to which the masks will be written
+
+            generate_per_class: bool, default=False
+                Whether additional images should be generated for each class.
+
+            Return
+            ------
+            The list of filepaths that were written
+        """
+        file_basename = os.path.basename(filepath)
+
+        output_paths = []
+        for class_id, out in self.render_masks(image, result, generate_per_class):
+            output_path = output_dir + "/" + str(class_id) + "/" + file_basename
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            skimage.io.imsave(output_path, out)
+            output_paths.append(output_path)
 
         return output_paths
 
-    def _save_masks(self, image, res, output_path):
-        captions = ["{:.3f}".format(score) for score in res['scores']]
-        visualize.display_instances(image, res['rois'], res['masks'], res['class_ids'],
-                                    self.class_names, res['scores'],
-                                    show_label=True, show_bbox=False,
-                                    captions=captions,
-                                    figsize=(8, 8), savepath=output_path)
-        out = post_process(skimage.io.imread(output_path))
-        skimage.io.imsave(output_path, out)
-
-    def _filter_for_class_id(self, result, class_id=None):
-        if class_id == 'all':
-            return result
-
-        filter = result['class_ids'] == class_id
+    def encode_result(self, result, mask_format=None, shape=None):
+        """Encode the detection result of a single image as a JSON serializable dict
+
+            Arguments
+            ---------
+            result: dict
+                The detection result for the image, as returned by detect
+
+            mask_format: str, optional
+                Either "rle", for COCO run-length encoded masks, or "polygon",
+                for COCO polygons. If not provided, masks are left out.
+
+            shape: tuple, optional
+                The (height, width) of the original image, if detection ran on
+                a reduced copy of it. Boxes and masks are mapped back to it.
+
+            Return
+            ------
+            A dict with the height and width of the image, and a list of instances,
+            each with its class_id, class_name, score, box (y1, x1, y2, x2) and mask
+        """
+        encode_mask = MASK_ENCODERS[mask_format] if mask_format else None
+        masks = result['masks']
+        rois = result['rois']
+        if encode_mask:
+            # Encode the masks from the crops of their boxes, full size masks of large
+            # images take a lot of time and memory to encode
+            masks = self._sparse_masks(masks, rois)
+        if shape is None:
+            shape = masks.shape[:2]
+        elif tuple(shape) != masks.shape[:2]:
+            rois = self._scale_rois(rois, masks.shape[:2], shape)
+            if encode_mask:
+                masks = resize_mask(masks, shape)
+
+        instances = []
+        for i, (roi, class_id, score) in enumerate(zip(rois, result['class_ids'], result['scores'])):
+            instance = {
+                "class_id": int(class_id),
+                "class_name": self.class_names[class_id],
+                "score": float(score),
+                "box": [int(v) for v in roi],
+            }
+            if encode_mask:
+                instance["mask"] = encode_mask(masks.crops[i], masks.boxes[i], shape)
+            instances.append(instance)
+
         return {
-            'rois': result['rois'][filter],
-            'masks': result['masks'][..., filter],
-            'class_ids': result['class_ids'][filter],
-            'scores': result['scores'][filter],
+            "height": int(shape[0]),
+            "width": int(shape[1]),
+            "instances": instances,
         }
+
+    def save_result(self, filepath, result, output_dir, mask_format="rle", shape=None):
+        """Persist the detection result of a single image as JSON, see encode_result
+
+            Return
+            ------
+            The filepath that was written, i.e. output_dir/json/[name].json
+        """
+        name = os.path.splitext(os.path.basename(filepath))[0] + ".json"
+        output_path = output_dir + "/json/" + name
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "w") as f:
+            json.dump(self.encode_result(result, mask_format, shape), f)
+
+        return output_path
+
+    def render_masks(self, image, result, generate_per_class=False):
+        """Render the masks from the detection result of a single image in memory
+
+            Arguments
+            ---------
+            image: np.ndarray
+                The image that the detection was run on
+
+            result: dict
+                The detection result for the image, as returned by detect
+
+            generate_per_class: bool, default=False
+                Whether additional images should be generated for each class.
+
+            Return
+            ------
+            A list of (class_id, image) pairs, where class_id is 'all' for the
+            image with all classes
+        """
+        # Each instance is drawn once, and shared by the image with all classes and that of its class
+        captions = ["{:.3f}".format(score) for score in result['scores']]
+        layers = instance_layers(image, result['rois'], result['masks'], captions=captions)
+
+        outputs = [('all', composite(image, layers))]
+        if generate_per_class:
+            for class_id in sorted(set(result['class_ids'])):
+                class_layers = [layer for layer, c in zip(layers, result['class_ids']) if c == class_id]
+                outputs.append((class_id, composite(image, class_layers)))
+
+        return outputs
+
+    def _load_image(self, source, reduced=False):
+        """Return an image from a filepath or an array, along with its full size (height, width)"""
+        if isinstance(source, np.ndarray):
+            return source, source.shape[:2]
+
+        if reduced:
+            with open(source, "rb") as f:
+                return self.read_image(f.read(), reduced=True)
+
+        image = skimage.io.imread(source)
+        return image, image.shape[:2]
+
+    def _sparse_masks(self, masks, rois):
+        """The masks as SparseMasks, cropping dense [height, width, N] masks to their rois"""
+        if isinstance(masks, utils.SparseMasks):
+            return masks
+
+        height, width = masks.shape[:2]
+        boxes = np.clip(rois, 0, [height, width, height, width]).reshape([-1, 4])
+        crops = [masks[y1:y2, x1:x2, i] for i, (y1, x1, y2, x2) in enumerate(boxes)]
+        return utils.SparseMasks(boxes, crops, masks.shape)
+
+    def _scale_rois(self, rois, from_shape, to_shape):
+        scale = np.array([to_shape[0] / from_shape[0], to_shape[1] / from_shape[1]] * 2)
+        return np.round(rois * scale).astype(rois.dtype)
@@ -0,0 +1,129 @@
+"""Pick the resolution to run detection at for each image
+
+research/resolution measured the mAP of the model on a shelf photo against
+the longest side of its content, both with fewer pixels (pixel resolution)
+and blurred (spatial resolution). Both curves rise steeply up to ~420 pixels
+and are flat above that, within the +/- 0.025 that the detections of an image
+vary by. Every image in those measurements was still detected at 1024 (the
+"square" resize mode upscales small images), so the curves show how much
+detail the model can use, not how accurate it is when run at a lower
+resolution.
+
+ResolutionPolicy assumes that an image whose content the curves rate as no
+better than that of a smaller copy can be detected at the size of that copy
+instead. That assumption is not measured: the objects are smaller relative
+to the anchors at lower resolutions. Compare the mAP on the test images with
+and without the policy before relying on it.
+"""
+
+import cv2
+import numpy as np
+
+# mAP against the longest side of the content of the image (in pixels), read off
+# the plots in research/resolution/pixel and research/resolution/spatial
+PIXEL_RESOLUTION_CURVE = [(52, 0.0), (105, 0.162), (211, 0.312), (422, 0.411), (844, 0.391), (2112, 0.377), (4224, 0.325)]
+SPATIAL_RESOLUTION_CURVE = [(42, 0.0), (84, 0.036), (211, 0.289), (422, 0.373), (2112, 0.365), (4224, 0.325)]
+
+# The frequency (in cycles per pixel) below which 90% of the gradient energy of a
+# sharp image lies, see detail_cutoff. Blurring an image by a factor of k divides it by k.
+SHARP_CUTOFF = 0.45
+
+
+def detail_cutoff(gray, energy=0.9):
+    """The frequency (in cycles per pixel, up to 0.5) below which a fraction energy of the gradient energy of an image lies
+
+    A measure of the finest detail in the image, which is lower for blurry images
+    than for sharp ones of the same size.
+    """
+    h, w = gray.shape
+    windowed = (gray - gray.mean()) * np.outer(np.hanning(h), np.hanning(w))
+    power = np.abs(np.fft.rfft2(windowed)) ** 2
+    frequency = np.sqrt(np.fft.fftfreq(h)[:, None] ** 2 + np.fft.rfftfreq(w)[None, :] ** 2).ravel()
+
+    # The power spectrum of the gradient is that of the image times the squared frequency
+    order = np.argsort(frequency)
+    cumulative = np.cumsum((power.ravel() * frequency ** 2)[order])
+    if cumulative[-1] == 0:
+        # A flat image has no detail at all
+        return 0.0
+    return frequency[order][np.searchsorted(cumulative, energy * cumulative[-1])]
+
+
+class ResolutionPolicy:
+    """Picks the resolution to detect an image at from the accuracy curves
+
+    The effective resolution of an image is the longest side of its content: its pixel
+    resolution, or less if it is blurry (see effective_resolution). The curves give the
+    mAP of the model for content of a given resolution. Shrinking an image to a
+    resolution is taken to lower its content to the lower of the two, and the policy
+    picks the lowest resolution at which the curves rate the content within tolerance
+    of its rating at max_dim. See the module docstring for what that does and does not
+    account for.
+    """
+    def __init__(self, min_dim=256, max_dim=1024, tolerance=0.01, step=64,
+                 curves=(PIXEL_RESOLUTION_CURVE, SPATIAL_RESOLUTION_CURVE)):
+        """Initialize the policy
+
+        Arguments
+        ---------
+        min_dim, max_dim: int
+            The range of resolutions (longest sides) to pick from
+
+        tolerance: float
+            How much lower than at max_dim the curves may rate the content at the picked resolution
+
+        step: int
+            The resolutions are multiples of this. 64 for the "pad64" resize mode.
+
+        curves: list
+            Curves of mAP against the longest side of the content of images, as lists of
+            (pixels, mAP). The expected mAP is the lowest of them.
+        """
+        self.min_dim = min_dim
+        self.max_dim = max_dim
+        self.tolerance = tolerance
+        self.curves = curves
+        self.resolutions = list(range(min_dim, max_dim + 1, step))
+        # The resolution that sharp, large images are detected at. There is no need to
+        # tell resolutions above it apart.
+        self.top_resolution = self.resolution_for(np.inf)
+
+    def __repr__(self):
+        return "ResolutionPolicy(min_dim={}, max_dim={}, tolerance={}, resolutions={}, curves={})".format(
+            self.min_dim, self.max_dim, self.tolerance, self.resolutions, self.curves)
+
+    def __call__(self, image):
+        """The resolution (longest side) to detect image at"""
+        return self.resolution_for(self.effective_resolution(image))
+
+    def expected_map(self, side):
+        """The mAP measured for content with side pixels on its longest side, detected at 1024"""
+        return min(np.interp(side, *zip(*curve)) for curve in self.curves)
+
+    def resolution_for(self, effective_resolution):
+        """The resolution to detect an image of the given effective resolution at"""
+        target = self.expected_map(min(self.max_dim, effective_resolution)) - self.tolerance
+        for resolution in self.resolutions:
+            if self.expected_map(min(resolution, effective_resolution)) >= target:
+                return resolution
+        return self.max_dim
+
+    def effective_resolution(self, image):
+        """Estimate the longest side of the content of an image, in pixels
+
+        This is the pixel resolution of the image, unless it is blurry, in which case it is
+        the resolution that it could be shrunk to without losing detail. It is estimated on
+        a copy of the image shrunk to top_resolution, so it is capped at that.
+        """
+        if image.ndim == 3:
+            gray = cv2.cvtColor(np.ascontiguousarray(image[..., :3]), cv2.COLOR_RGB2GRAY)
+        else:
+            gray = image
+        side = max(gray.shape)
+        if side > self.top_resolution:
+            scale = self.top_resolution / side
+            gray = cv2.resize(gray, (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale))),
+                              interpolation=cv2.INTER_AREA)
+
+        analysed = max(gray.shape)
+        return min(side, analysed * detail_cutoff(gray.astype(np.float32)) / SHARP_CUTOFF)
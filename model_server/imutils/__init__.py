@@ -1 +1,2 @@
 from .imutils import *
+from .render import *
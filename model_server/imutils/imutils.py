@@ -1,70 +1,80 @@
 """Utility methods for manipulating images"""
 
-import numpy as np
-
-def post_process(im):
-    """Remove the padding added by the model"""
-    for i in range(im.shape[0]):
-        for j in range(im.shape[1]):
-            replace_pixel_with_white(im, i, j)
-
-    return remove_border(im)
-
-
-def replace_pixel_with_white(im, i, j, threshold=200):
-    r, g, b = im[i, j, :]
-    if r >= threshold and g >= threshold and b >= threshold:
-        im[i, j, :] = np.array([255, 255, 255])
-
-def remove_border(im):
-    """Remove the border (frame) of an image if it is a constant pattern"""
-    for trimmer in [trim_top, trim_bottom, trim_left, trim_right]:
-        im = trimmer(im)
-
-    return im
-
-def trim_top(im):
-    i = 1
-
-    if not np.all(im[0, :, :] == im[i, :, :]):
-        return im
-
-    while np.all(im[0, :, :] == im[i, :, :]):
-        i += 1
-
-    return im[i:, :, :]
+import os
+from io import BytesIO
+from math import ceil
 
-def trim_bottom(im):
-    height = im.shape[0] - 1
-    i = height - 1
-
-    if not np.all(im[height, :, :] == im[i, :, :]):
-        return im
-
-    while np.all(im[height, :, :] == im[i, :, :]):
-        i -= 1
-
-    return im[:i, :, :]
-
-def trim_left(im):
-    i = 1
-
-    if not np.all(im[:, 0, :] == im[:, i, :]):
-        return im
-
-    while np.all(im[:, 0, :] == im[:, i, :]):
-        i += 1
-
-    return im[:, i:, :]
-
-def trim_right(im):
-    width = im.shape[1] - 1
-    i = width - 1
-
-    if not np.all(im[:, width, :] == im[:, i, :]):
-        return im
-
-    while np.all(im[:, width, :] == im[:, i, :]):
-        i -= 1
+import numpy as np
+from PIL import Image
+from skimage.measure import find_contours, approximate_polygon
+
+
+def decode_image(data, max_dim=None):
+    """Decode an encoded image (e.g. the contents of a JPG file) into an RGB array
+
+    If max_dim is provided, JPEGs whose longest side is above it are decoded at
+    a reduced size (1/2, 1/4 or 1/8) directly, in the DCT domain, as long as the
+    longest side stays at least max_dim. Other formats are decoded at full size.
+    """
+    im = Image.open(BytesIO(data))
+    if max_dim:
+        width, height = im.size
+        scale = max_dim / max(width, height)
+        if scale < 1:
+            im.draft("RGB", (ceil(width * scale), ceil(height * scale)))
+    return np.array(im.convert("RGB"))
+
+
+def image_shape(data):
+    """The (height, width) of an encoded image, read from its header only"""
+    width, height = Image.open(BytesIO(data)).size
+    return height, width
+
+
+def resize_mask(mask, shape):
+    """Resize a binary mask (or a stack of masks along the last axis) to (height, width) shape
+
+    Nearest neighbour interpolation is used, so the mask stays binary. Sparse
+    masks (see mrcnn's utils.SparseMasks) are resized without densifying them.
+    """
+    if hasattr(mask, "rescale"):
+        return mask.rescale(shape)
+
+    rows = np.arange(shape[0]) * mask.shape[0] // shape[0]
+    cols = np.arange(shape[1]) * mask.shape[1] // shape[1]
+    return mask[rows[:, None], cols]
+
+
+def encode_image(im, filename):
+    """Encode an image array in the format implied by the extension of filename"""
+    Image.init()
+    extension = os.path.splitext(filename)[1].lower()
+    buffer = BytesIO()
+    Image.fromarray(im).save(buffer, format=Image.EXTENSION.get(extension, "PNG"))
+    return buffer.getvalue()
+
+
+def mask_to_polygons(mask, tolerance=1, offset=(0, 0)):
+    """Trace the outlines of a binary mask as COCO polygons, i.e. lists of [x1, y1, x2, y2, ...]
+
+    Outlines are simplified so that no point moves by more than tolerance pixels.
+    If mask is a crop of a larger image, offset is the (y, x) of its top left
+    corner in the image, and the points are in the coordinates of the image.
+    """
+    # Pad the mask so that regions touching the edges are closed
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=np.uint8)
+    padded[1:-1, 1:-1] = mask
+
+    polygons = []
+    for contour in find_contours(padded, 0.5):
+        simplified = approximate_polygon(contour, tolerance)
+        # Small regions may collapse to a line, keep their full outline instead
+        # Undo the padding, and move from pixel centers to pixel edges, as in COCO
+        contour = (simplified if len(simplified) > 3 else contour) - 0.5 + offset
+        if len(contour) < 3:
+            continue
+        # Contours are (row, column) points, polygons are (x, y)
+        polygons.append(np.round(contour[:, ::-1], 1).ravel().tolist())
+
+    return polygons
 
-    return im[:, :i, :]
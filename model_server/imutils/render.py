@@ -0,0 +1,132 @@
+"""Draw detected instances onto images, without matplotlib
+
+Produces the same overlay as mrcnn's visualize.display_instances (a tint and an
+outline per mask, and a caption per instance) directly into a uint8 array of
+the same size as the image.
+"""
+
+import colorsys
+from collections import namedtuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def instance_colors(n, bright=True):
+    """Visually distinct RGB colors (0 - 255), evenly spaced in hue
+
+    Unlike visualize.random_colors, the colors are not shuffled, so that the
+    same detections are always drawn the same way.
+    """
+    brightness = 1.0 if bright else 0.7
+    return [tuple(int(round(255 * c)) for c in colorsys.hsv_to_rgb(i / n, 1, brightness))
+            for i in range(n)]
+
+
+def _outline(mask, thickness):
+    """The pixels of mask that are within thickness pixels of its boundary"""
+    inner = np.pad(mask, 1, mode="constant")
+    for _ in range(thickness):
+        inner = np.pad(inner[1:-1, 1:-1] & inner[:-2, 1:-1] & inner[2:, 1:-1] & inner[1:-1, :-2] & inner[1:-1, 2:],
+                       1, mode="constant")
+    return mask & ~inner[1:-1, 1:-1]
+
+
+# The contribution of one instance to a rendered image: the pixels that it paints
+# within its (clipped) box, and their values, along with its caption
+InstanceLayer = namedtuple("InstanceLayer", ["box", "mask", "pixels", "caption"])
+
+
+def instance_layers(image, boxes, masks, captions=None, colors=None, alpha=0.5, thickness=None):
+    """Compute the contribution of each instance to the overlay, see draw_instances for the arguments
+
+    Each layer is computed from the image alone, so any subset of the layers
+    can be composited without recomputing them.
+
+    Return
+    ------
+    A list of InstanceLayer, with None for instances that have no box
+    """
+    n = boxes.shape[0]
+    colors = colors or instance_colors(n)
+    captions = captions or [None] * n
+    if thickness is None:
+        thickness = max(1, int(round(max(image.shape[:2]) / 800)))
+
+    height, width = image.shape[:2]
+    layers = []
+    for i in range(n):
+        if not np.any(boxes[i]):
+            # Has no bbox, likely lost in image cropping
+            layers.append(None)
+            continue
+        y1, x1, y2, x2 = (int(v) for v in boxes[i])
+        y1, x1 = max(y1, 0), max(x1, 0)
+        y2, x2 = min(y2, height), min(x2, width)
+        if y2 <= y1 or x2 <= x1:
+            layers.append(None)
+            continue
+
+        mask = masks[y1:y2, x1:x2, i].astype(bool)
+        color = np.array(colors[i], dtype=np.float32)
+
+        painted = image[y1:y2, x1:x2, :3].astype(np.uint8, copy=True)
+        painted[mask] = (painted[mask] * (1 - alpha) + alpha * color).astype(np.uint8)
+        painted[_outline(mask, thickness)] = color.astype(np.uint8)
+
+        layers.append(InstanceLayer((y1, x1, y2, x2), mask, painted[mask], captions[i]))
+
+    return layers
+
+
+def composite(image, layers):
+    """Paint layers (see instance_layers) onto a copy of image, in order"""
+    out = image[..., :3].astype(np.uint8, copy=True)
+    layers = [layer for layer in layers if layer is not None]
+    for layer in layers:
+        y1, x1, y2, x2 = layer.box
+        out[y1:y2, x1:x2][layer.mask] = layer.pixels
+
+    if any(layer.caption for layer in layers):
+        canvas = Image.fromarray(out)
+        draw = ImageDraw.Draw(canvas)
+        for layer in layers:
+            if layer.caption:
+                draw.text((layer.box[1], layer.box[0]), layer.caption, fill=(255, 255, 255))
+        out = np.array(canvas)
+
+    return out
+
+
+def draw_instances(image, boxes, masks, captions=None, colors=None, alpha=0.5, thickness=None):
+    """Draw the masks of detected instances onto a copy of image
+
+    Arguments
+    ---------
+    image: np.ndarray
+        The RGB image that the instances were detected in
+
+    boxes: np.ndarray
+        [num_instances, (y1, x1, y2, x2)] in image coordinates. Only the pixels
+        of each mask within its box are drawn.
+
+    masks: np.ndarray
+        [height, width, num_instances] binary masks
+
+    captions: list[str], optional
+        A caption per instance, drawn at the top left of its box
+
+    colors: list, optional
+        An RGB color (0 - 255) per instance. See instance_colors for the default.
+
+    alpha: float
+        The opacity of the mask tint
+
+    thickness: int, optional
+        The width of the mask outlines in pixels. Scales with the image by default.
+
+    Return
+    ------
+    The annotated image, as a uint8 array of the same size as image
+    """
+    return composite(image, instance_layers(image, boxes, masks, captions, colors, alpha, thickness))
@@ -10,7 +10,6 @@ import matplotlib
 import matplotlib.pyplot as plt
 
 from ...api import MaskRCNNModel
-from ...imutils import post_process
 
 # Import Mask RCNN
 import utils
@@ -65,4 +64,4 @@ class CocoModel(MaskRCNNModel):
         self.items = items or class_names
 
     def load(self, filepath=COCO_MODEL_PATH):
-        self.model.load_weights(filepath, by_name=True)
+        super().load(filepath)
@@ -28,3 +28,6 @@ class InferenceConfig(Config):
     # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
     GPU_COUNT = 1
     IMAGES_PER_GPU = 1
+
+    # Mold images with OpenCV, see Config.FAST_MOLDING
+    FAST_MOLDING = True
@@ -9,8 +9,7 @@ import skimage.io
 import matplotlib
 import matplotlib.pyplot as plt
 
-from ...api import MaskRCNNModel
-from ...imutils import post_process
+from ...api import MaskRCNNModel, ResolutionPolicy
 
 # Import Mask RCNN
 import utils
@@ -28,7 +27,9 @@ CLOMASK_MODEL_PATH = os.path.join(ROOT_DIR, "mask_rcnn_clomask_0055.h5")
 
 
 class ClomaskModel(MaskRCNNModel):
-    def __init__(self, class_names):
+    def __init__(self, class_names, batch_size=1, frozen_graph=None,
+                 intra_op_threads=None, inter_op_threads=None, cpu_affinity=None, cascade=False,
+                 adaptive_resolution=False):
         """Initialize the Clomask Model
 
         Arguments
@@ -36,8 +37,34 @@ class ClomaskModel(MaskRCNNModel):
         items: list-like
             Only items from this list will be annotated, and the rest will be discarded.
             If not provided, all masks are generated.
+
+        batch_size: int, default=1
+            The number of images the model runs through detection at once.
+
+        frozen_graph: str, optional
+            Run this graph, exported with export_frozen_graph and the same batch size,
+            instead of building the model and loading its weights.
+
+        intra_op_threads, inter_op_threads, cpu_affinity: optional
+            The threading profile of the TensorFlow session that the model runs in. The
+            sizes of its thread pools, and the cores it runs on. TensorFlow's defaults
+            (all cores) are used if not provided.
+
+        cascade: bool, default=False
+            Whether to run a cheap low resolution pass first, and detect at full resolution
+            only the images that need it
+
+        adaptive_resolution: bool, default=False
+            Whether to detect each image at a resolution picked from its size, its sharpness
+            and the accuracy curves in research/resolution, see ResolutionPolicy, instead of
+            at 1024
         """
-        super().__init__(name="Clomask", config=InferenceConfig(), model_dir=MODEL_DIR, class_names=class_names)
+        config = InferenceConfig(images_per_gpu=batch_size, intra_op_threads=intra_op_threads,
+                                 inter_op_threads=inter_op_threads, cpu_affinity=cpu_affinity,
+                                 resize_mode="pad64" if adaptive_resolution else None)
+        resolution_policy = ResolutionPolicy(max_dim=config.IMAGE_MAX_DIM) if adaptive_resolution else None
+        super().__init__(name="Clomask", config=config, model_dir=MODEL_DIR, class_names=class_names,
+                         frozen_graph=frozen_graph, cascade=cascade, resolution_policy=resolution_policy)
 
     def load(self, filepath=CLOMASK_MODEL_PATH):
-        self.model.load_weights(filepath, by_name=True)
+        super().load(filepath)
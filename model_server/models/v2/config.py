@@ -70,6 +70,20 @@ class ClomaskConfig(Config):
 
 
 class InferenceConfig(ClomaskConfig):
+    """Inference configuration for Clomask
+
+    Arguments
+    ---------
+    images_per_gpu: int, optional
+        Overrides IMAGES_PER_GPU, so that the model is built to run
+        detection on batches of this size.
+
+    intra_op_threads, inter_op_threads, cpu_affinity: optional
+        Override the threading profile, see Config.INTRA_OP_THREADS
+
+    resize_mode: str, optional
+        Overrides IMAGE_RESIZE_MODE
+    """
     GPU_COUNT = 1
     IMAGES_PER_GPU = 1
     IMAGE_RESIZE_MODE = "square"
@@ -80,3 +94,15 @@ class InferenceConfig(ClomaskConfig):
     RPN_ANCHOR_SCALES = (16, 32, 64, 128, 256)
     DETECTION_MAX_INSTANCES = 300
     DETECTION_MIN_CONFIDENCE = 0.85
+    FAST_MOLDING = True
+
+    def __init__(self, images_per_gpu=None, intra_op_threads=None, inter_op_threads=None, cpu_affinity=None,
+                 resize_mode=None):
+        if images_per_gpu:
+            self.IMAGES_PER_GPU = images_per_gpu
+        if resize_mode:
+            self.IMAGE_RESIZE_MODE = resize_mode
+        self.INTRA_OP_THREADS = intra_op_threads
+        self.INTER_OP_THREADS = inter_op_threads
+        self.CPU_AFFINITY = cpu_affinity
+        super().__init__()
@@ -0,0 +1,219 @@
+"""Queue and blob store backends for the model server
+
+The server reads S3 event notifications off a message queue, downloads images
+from an input store and uploads the outputs to an output store. In production
+these are SQS and S3. The local backends implement the same interfaces on top
+of the filesystem, so that the full server loop can run (and be benchmarked)
+without AWS:
+
+local
+ |- queue
+     |- pending
+     |- inflight
+ |- input
+ |- output
+"""
+
+import os
+import json
+import shutil
+from abc import ABC, abstractmethod
+from io import BytesIO
+from collections import namedtuple
+from time import time, sleep
+from uuid import uuid4
+
+from .config import *
+
+Backends = namedtuple("Backends", ["queue", "input_store", "output_store"])
+
+Message = namedtuple("Message", ["body", "receipt_handle"])
+
+
+class MessageQueue(ABC):
+    @abstractmethod
+    def receive(self, max_messages, wait_seconds):
+        """Receive up to max_messages messages, waiting up to wait_seconds for the first one
+
+        Received messages are hidden from other consumers until their visibility
+        timeout expires, after which they are delivered again unless deleted.
+
+        Return
+        ------
+        A list of objects with a body and a receipt_handle
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, receipt_handles):
+        """Delete received messages, so that they are not delivered again"""
+        pass
+
+
+class BlobStore(ABC):
+    @abstractmethod
+    def download(self, key, filename):
+        pass
+
+    @abstractmethod
+    def download_bytes(self, key):
+        pass
+
+    @abstractmethod
+    def upload(self, filename, key):
+        pass
+
+    @abstractmethod
+    def upload_bytes(self, data, key):
+        pass
+
+
+class SQSQueue(MessageQueue):
+    def __init__(self, url):
+        import boto3
+        self.queue = boto3.resource("sqs").Queue(url)
+
+    def receive(self, max_messages, wait_seconds):
+        return self.queue.receive_messages(MaxNumberOfMessages=max_messages, WaitTimeSeconds=wait_seconds)
+
+    def delete(self, receipt_handles):
+        # SQS deletes at most 10 messages per call
+        for i in range(0, len(receipt_handles), 10):
+            entries = [{'Id': str(j), 'ReceiptHandle': receipt_handle}
+                       for j, receipt_handle in enumerate(receipt_handles[i:i + 10])]
+            self.queue.delete_messages(Entries=entries)
+
+
+class S3Store(BlobStore):
+    def __init__(self, bucket_name):
+        import boto3
+        self.bucket = boto3.resource("s3").Bucket(bucket_name)
+
+    def download(self, key, filename):
+        self.bucket.download_file(Key=key, Filename=filename)
+
+    def download_bytes(self, key):
+        buffer = BytesIO()
+        self.bucket.download_fileobj(Key=key, Fileobj=buffer)
+        return buffer.getvalue()
+
+    def upload(self, filename, key):
+        self.bucket.upload_file(Filename=filename, Key=key)
+
+    def upload_bytes(self, data, key):
+        self.bucket.upload_fileobj(Fileobj=BytesIO(data), Key=key)
+
+
+class LocalQueue(MessageQueue):
+    """A message queue backed by a directory, with one file per message
+
+    Messages are received by atomically moving them from the pending directory
+    to the inflight directory, so several processes can share the queue.
+    """
+    def __init__(self, directory, visibility_timeout=LOCAL_QUEUE_VISIBILITY_TIMEOUT_IN_SEC):
+        self.pending_dir = os.path.join(directory, "pending")
+        self.inflight_dir = os.path.join(directory, "inflight")
+        self.visibility_timeout = visibility_timeout
+        os.makedirs(self.pending_dir, exist_ok=True)
+        os.makedirs(self.inflight_dir, exist_ok=True)
+
+    def send(self, body):
+        # Name messages by time, so that they are received in order
+        name = "{:017.6f}-{}.json".format(time(), uuid4().hex)
+        tmp = os.path.join(self.inflight_dir, ".tmp-" + name)
+        with open(tmp, "w") as f:
+            f.write(body)
+        os.rename(tmp, os.path.join(self.pending_dir, name))
+
+    def receive(self, max_messages, wait_seconds):
+        deadline = time() + wait_seconds
+        while True:
+            self._requeue_expired()
+
+            messages = []
+            for name in sorted(os.listdir(self.pending_dir)):
+                if len(messages) == max_messages:
+                    break
+                inflight = os.path.join(self.inflight_dir, name)
+                try:
+                    os.rename(os.path.join(self.pending_dir, name), inflight)
+                    with open(inflight) as f:
+                        messages.append(Message(f.read(), name))
+                except FileNotFoundError:
+                    # Received by another consumer
+                    continue
+
+            if messages or time() >= deadline:
+                return messages
+
+            sleep(LOCAL_QUEUE_POLL_INTERVAL_IN_SEC)
+
+    def delete(self, receipt_handles):
+        for receipt_handle in receipt_handles:
+            try:
+                os.remove(os.path.join(self.inflight_dir, receipt_handle))
+            except FileNotFoundError:
+                pass
+
+    def _requeue_expired(self):
+        # The ctime of a message is updated when it's moved, i.e. when it's received
+        now = time()
+        for name in os.listdir(self.inflight_dir):
+            if name.startswith(".tmp-"):
+                continue
+            inflight = os.path.join(self.inflight_dir, name)
+            try:
+                if now - os.stat(inflight).st_ctime > self.visibility_timeout:
+                    os.rename(inflight, os.path.join(self.pending_dir, name))
+            except FileNotFoundError:
+                continue
+
+
+class LocalStore(BlobStore):
+    """A blob store backed by a directory, where keys are relative paths"""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, create=False):
+        path = os.path.join(self.directory, key)
+        if create:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def download(self, key, filename):
+        shutil.copyfile(self._path(key), filename)
+
+    def download_bytes(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def upload(self, filename, key):
+        shutil.copyfile(filename, self._path(key, create=True))
+
+    def upload_bytes(self, data, key):
+        with open(self._path(key, create=True), "wb") as f:
+            f.write(data)
+
+    def keys(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                yield os.path.relpath(os.path.join(root, name), self.directory)
+
+
+def make_s3_event(key):
+    """Build the body of an S3 event notification for an uploaded object"""
+    return json.dumps({"Records": [{"s3": {"object": {"key": key.replace(" ", "+")}}}]})
+
+
+def make_backends(backend, local_dir=None):
+    """Create the queue and stores for a backend, either "aws" or "local" """
+    if backend == "aws":
+        return Backends(SQSQueue(SQS_URL), S3Store(INPUT_S3_BUCKET_NAME), S3Store(OUTPUT_S3_BUCKET_NAME))
+
+    if backend == "local":
+        return Backends(LocalQueue(os.path.join(local_dir, "queue")),
+                        LocalStore(os.path.join(local_dir, "input")),
+                        LocalStore(os.path.join(local_dir, "output")))
+
+    raise ValueError("Unknown backend {}".format(backend))
@@ -0,0 +1,136 @@
+"""A content-addressed cache for the outputs of the model server
+
+Many uploads are re-sends of the same photo. The outputs for an image are fully
+determined by its bytes and by the model that processed it, so they are cached
+on local disk under a hash of both, and evicted least recently used first once
+the cache grows beyond its size limit.
+
+Each entry is a directory named after its key, with one file per output:
+
+cache
+ |- [key]
+     |- all
+     |- 1
+     |- ...
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from uuid import uuid4
+
+
+class ResultCache:
+    """An LRU cache of rendered outputs on local disk
+
+    Arguments
+    ---------
+    directory: str, path-like
+        The directory in which entries are stored. It may be shared by several
+        processes, as long as they use the same namespace for the same model.
+
+    max_bytes: int
+        The total size of the cached outputs above which entries are evicted
+
+    namespace: str
+        Identifies everything besides the image that determines the outputs,
+        e.g. the model's fingerprint. It is part of every key.
+    """
+    def __init__(self, directory, max_bytes, namespace):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._scan())
+
+    def key(self, data, filename):
+        """The cache key for the image data, which was uploaded as filename
+
+        The extension of the filename is part of the key, since the outputs
+        are encoded in the same format as the input.
+        """
+        digest = hashlib.sha256()
+        digest.update(self.namespace.encode())
+        digest.update(os.path.splitext(filename)[1].lower().encode())
+        digest.update(data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached outputs as a list of (label, bytes) pairs, or None on a miss"""
+        entry = os.path.join(self.directory, key)
+        try:
+            outputs = []
+            for label in sorted(os.listdir(entry)):
+                with open(os.path.join(entry, label), "rb") as f:
+                    outputs.append((label, f.read()))
+            # Mark the entry as recently used
+            os.utime(entry)
+        except FileNotFoundError:
+            # Either a miss, or the entry was evicted while we were reading it
+            return None
+
+        return outputs
+
+    def put(self, key, outputs):
+        """Cache a list of (label, bytes) outputs under key"""
+        entry = os.path.join(self.directory, key)
+        if os.path.exists(entry):
+            return
+
+        # Write to a temporary directory first, so that readers never see partial entries
+        tmp = os.path.join(self.directory, ".tmp-" + uuid4().hex)
+        os.makedirs(tmp)
+        size = 0
+        for label, data in outputs:
+            with open(os.path.join(tmp, str(label)), "wb") as f:
+                f.write(data)
+            size += len(data)
+
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another thread or process cached the same image in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        with self.lock:
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        """Return (mtime, path, size) for every entry, least recently used first"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".tmp-") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), path, size))
+            except FileNotFoundError:
+                continue
+
+        return sorted(entries)
+
+    def _evict(self):
+        # Rescan, since other processes may have added or evicted entries
+        entries = self._scan()
+        self.total_bytes = sum(size for _, _, size in entries)
+
+        for _, path, size in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            # Move the entry out of the way first, so that readers never see a partial entry
+            trash = os.path.join(self.directory, ".tmp-" + uuid4().hex)
+            try:
+                os.rename(path, trash)
+            except OSError:
+                continue
+            shutil.rmtree(trash, ignore_errors=True)
+            self.total_bytes -= size
+            logging.debug("Evicted %s from the result cache", path)
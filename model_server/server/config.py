@@ -6,3 +6,50 @@ INPUT_S3_BUCKET_NAME = "clomask-input"
 
 # The output bucket for files with masks
 OUTPUT_S3_BUCKET_NAME = "clomask-output"
+
+# The maximum number of images that are run through the model at once
+BATCH_SIZE = 1
+
+# How long to keep collecting messages for a batch once the first one arrives
+BATCH_MAX_WAIT_IN_SEC = 1
+
+# Thread pool sizes for the stages of the pipelined server (--pipeline)
+DOWNLOAD_WORKERS = 4
+UPLOAD_WORKERS = 4
+
+RENDER_WORKERS = 4
+
+# The maximum number of images waiting between two pipeline stages
+PIPELINE_QUEUE_SIZE = 16
+
+# The number of worker processes, each with its own copy of the model (--workers)
+WORKERS = 1
+
+# TensorFlow thread pool sizes for each worker.
+# 0 intra-op threads means that the cores are split evenly between the workers.
+WORKER_INTRA_OP_THREADS = 0
+WORKER_INTER_OP_THREADS = 2
+
+# Worker health checks
+WORKER_CHECK_INTERVAL_IN_SEC = 5
+WORKER_STARTUP_TIMEOUT_IN_SEC = 300
+WORKER_HEARTBEAT_TIMEOUT_IN_SEC = 120
+WORKER_STOP_TIMEOUT_IN_SEC = 10
+
+# The size of the result cache (--cache-dir), above which least recently used outputs are evicted
+RESULT_CACHE_SIZE_MB = 1024
+
+# The local backend (--backend local) stands in for SQS and S3 with directories
+LOCAL_DIR = "local"
+LOCAL_QUEUE_VISIBILITY_TIMEOUT_IN_SEC = 300
+LOCAL_QUEUE_POLL_INTERVAL_IN_SEC = 0.1
+
+# The port on which latency and throughput metrics are served (--metrics-port).
+# Worker processes use consecutive ports starting from this one.
+METRICS_PORT = 9100
+
+# The synchronous HTTP server (server/http_server.py)
+HTTP_PORT = 8080
+HTTP_MAX_LATENCY_IN_SEC = 0.05
+HTTP_QUEUE_SIZE = 64
+HTTP_REQUEST_TIMEOUT_IN_SEC = 60
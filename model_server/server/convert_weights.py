@@ -0,0 +1,46 @@
+"""Convert the h5 weights of the model to a memory-mapped weight store
+
+Loading h5 weights parses the file layer by layer on every start of a
+server. A weight store is memory-mapped instead, so loading it is bound by
+the disk and takes less time and memory. The weights are still copied into
+the model, so each worker holds its own copy once it is loaded:
+
+    python3 -m model_server.server.convert_weights --output weights
+    python3 -m model_server.server.model_server --workers 4 --weights weights
+"""
+import os
+import sys
+import logging
+from argparse import ArgumentParser
+from time import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s [%(process)d] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+abspath = os.path.abspath
+sys.path.extend([
+    abspath("mrcnn"),
+    abspath("mrcnn/scripts")
+])
+
+import utils
+
+from ..models.v2.clomask_model import CLOMASK_MODEL_PATH
+
+
+def parse_args():
+    """Parse arguments from the command line"""
+    parser = ArgumentParser(description="Convert h5 weights to a memory-mapped weight store")
+    parser.add_argument("--weights", required=False, default=CLOMASK_MODEL_PATH, help="The h5 weights to convert")
+    parser.add_argument("--output", required=True, help="The directory to write the weight store to")
+
+    return parser.parse_args()
+
+
+def main(args):
+    start = time()
+    utils.convert_h5_weights(args.weights, args.output)
+    logging.info("Converted %s to %s in %.1f seconds", args.weights, args.output, time() - start)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,57 @@
+"""Export the model to a frozen inference graph
+
+Building the model and loading its weights takes tens of seconds on every
+start of a server. The exported graph has the weights folded into it, and
+loads in a fraction of that time:
+
+    python3 -m model_server.server.export_graph --batch-size 4 --output clomask_b4.pb
+    python3 -m model_server.server.model_server --batch-size 4 --frozen-graph clomask_b4.pb
+
+The graph only runs with the batch size that it was exported with.
+"""
+import os
+import sys
+import logging
+from argparse import ArgumentParser
+from time import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s [%(process)d] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+abspath = os.path.abspath
+sys.path.extend([
+    abspath("mrcnn"),
+    abspath("mrcnn/scripts")
+])
+
+from .config import *
+from ..models import ClomaskModel
+from ..models.v2.clomask_model import CLOMASK_MODEL_PATH
+
+
+def parse_args():
+    """Parse arguments from the command line"""
+    parser = ArgumentParser(description="Export the model, with its weights, to a frozen inference graph")
+    parser.add_argument("--output", required=True, help="The path of the graph to write")
+    parser.add_argument("--weights", required=False, default=CLOMASK_MODEL_PATH, help="The weights to export")
+    parser.add_argument("--batch-size", required=False, type=int, default=BATCH_SIZE, help="The batch size that the graph will run with")
+
+    return parser.parse_args()
+
+
+def main(args):
+    class_names = [None, 'bottle', 'box', 'bag']
+
+    start = time()
+    model = ClomaskModel(class_names=class_names, batch_size=args.batch_size)
+    model.load(args.weights)
+    logging.info("Built the model and loaded its weights in %.1f seconds", time() - start)
+
+    model.export_frozen_graph(args.output)
+
+    start = time()
+    ClomaskModel(class_names=class_names, batch_size=args.batch_size, frozen_graph=args.output)
+    logging.info("Exported %s, which loads in %.1f seconds", args.output, time() - start)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,185 @@
+"""Serve the model synchronously over HTTP
+
+Unlike the queue based server, which suits uploads that are processed in the
+background, this serves interactive clients that wait for the response:
+
+    curl --data-binary @shelf.jpg localhost:8080/predict     # detections as JSON
+    curl --data-binary @shelf.jpg localhost:8080/predict?masks=rle   # with RLE (or polygon) masks
+    curl --data-binary @shelf.jpg localhost:8080/render      # annotated image (PNG)
+
+Concurrent requests are grouped into batches by a dynamic batcher. A batch is
+run as soon as it is full, or once its oldest request has waited --max-latency
+seconds, so batching never adds more than that to the latency of a request.
+"""
+import os
+import sys
+import json
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from queue import Queue
+from urllib.parse import urlparse, parse_qs
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s [%(process)d] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+abspath = os.path.abspath
+sys.path.extend([
+    abspath("mrcnn"),
+    abspath("mrcnn/scripts")
+])
+
+from .config import *
+from .pipeline import BatchStage
+from .metrics import METRICS, ThreadingHTTPServer, start_metrics_server
+from .supervisor import worker_threading_profile
+from ..api.maskrcnn_api import MASK_ENCODERS
+from ..models import ClomaskModel
+from ..models.v2.clomask_model import CLOMASK_MODEL_PATH
+from ..imutils import encode_image
+
+
+class DynamicBatcher:
+    """Group images submitted from concurrent threads into detection batches
+
+    Arguments
+    ---------
+    model: MaskRCNNModel
+        The model to run detection with. Only the batcher's thread uses it.
+
+    batch_size: int
+        The maximum number of images per batch
+
+    max_latency: float
+        The longest time (in seconds) that an image waits for its batch to fill up
+
+    queue_size: int
+        The maximum number of images waiting to be batched. Submitting blocks
+        while the queue is full.
+    """
+    def __init__(self, model, batch_size, max_latency, queue_size=HTTP_QUEUE_SIZE):
+        self.model = model
+        self.inbox = Queue(maxsize=queue_size)
+        self.stage = BatchStage("batcher", self._detect, self.inbox, on_error=self._fail,
+                                batch_size=batch_size, max_wait=max_latency)
+
+    def start(self):
+        self.stage.start()
+        return self
+
+    def submit(self, image):
+        """Queue an image for detection, and return a Future of its result"""
+        future = Future()
+        self.inbox.put((image, future))
+        return future
+
+    def _detect(self, requests):
+        timings = {}
+        results = self.model.detect([image for image, _ in requests], timings=timings, sparse_masks=True)
+        for step, seconds in timings.items():
+            METRICS.observe(step, seconds)
+        METRICS.inc("images", len(requests))
+
+        for (_, future), result in zip(requests, results):
+            METRICS.inc("instances", len(result['class_ids']))
+            future.set_result(result)
+
+    def _fail(self, requests, error):
+        METRICS.inc("failures", len(requests))
+        for _, future in requests:
+            future.set_exception(error)
+
+
+def make_handler(model, batcher, reduced_decode=False):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlparse(self.path)
+            path = url.path
+            if path not in ("/predict", "/render"):
+                self.send_error(404)
+                return
+
+            mask_format = parse_qs(url.query).get("masks", [None])[0]
+            if mask_format is not None and mask_format not in MASK_ENCODERS:
+                self.send_error(400, "masks must be one of " + ", ".join(MASK_ENCODERS))
+                return
+
+            try:
+                with METRICS.timed("decode"):
+                    image, shape = model.read_image(self.rfile.read(int(self.headers["Content-Length"])), reduced_decode)
+            except Exception:
+                self.send_error(400, "The request body must be an image")
+                return
+
+            with METRICS.timed("request"):
+                try:
+                    result = batcher.submit(image).result(timeout=HTTP_REQUEST_TIMEOUT_IN_SEC)
+                except Exception:
+                    logging.exception("Detection failed")
+                    self.send_error(500)
+                    return
+
+                if path == "/predict":
+                    with METRICS.timed("encode"):
+                        body = json.dumps(model.encode_result(result, mask_format, shape)).encode()
+                    self._respond(body, "application/json")
+                else:
+                    with METRICS.timed("render"):
+                        [(_, rendered)] = model.render_masks(image, result)
+                    self._respond(encode_image(rendered, "render.png"), "image/png")
+
+        def _respond(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    return Handler
+
+
+def parse_args():
+    """Parse arguments from the command line"""
+    parser = ArgumentParser(description="Serve the Clomask model over HTTP")
+    parser.add_argument("--port", required=False, type=int, default=HTTP_PORT, help="The port to serve on")
+    parser.add_argument("--batch-size", required=False, type=int, default=BATCH_SIZE, help="The maximum number of concurrent requests to run through the model at once")
+    parser.add_argument("--weights", required=False, default=CLOMASK_MODEL_PATH, help="The h5 weights to load, or a weight store converted from them by convert_weights")
+    resolution = parser.add_mutually_exclusive_group()
+    resolution.add_argument("--cascade", action="store_true", help="Detect at a low resolution first, and at full resolution only the images with many, small or uncertain detections")
+    resolution.add_argument("--adaptive-resolution", action="store_true", help="Detect each image at a resolution picked from its size and sharpness, instead of at 1024")
+    parser.add_argument("--frozen-graph", required=False, default=None, help="Run this graph, exported by export_graph with the same batch size, instead of building the model")
+    parser.add_argument("--max-latency", required=False, type=float, default=HTTP_MAX_LATENCY_IN_SEC, help="How long (in seconds) a request may wait for its batch to fill up")
+    parser.add_argument("--reduced-decode", action="store_true", help="Decode JPEGs straight to the (smaller) size that the model needs, instead of at full size")
+    parser.add_argument("--intra-op-threads", required=False, type=int, default=WORKER_INTRA_OP_THREADS, help="TensorFlow intra-op threads. Defaults to one per core")
+    parser.add_argument("--inter-op-threads", required=False, type=int, default=WORKER_INTER_OP_THREADS, help="TensorFlow inter-op threads")
+    parser.add_argument("--pin-cores", action="store_true", help="Pin the server to as many cores as its intra-op threads")
+    parser.add_argument("--metrics-port", required=False, type=int, default=METRICS_PORT, help="Serve latency and throughput metrics on this port (0 to disable)")
+
+    return parser.parse_args()
+
+
+def main(args):
+    logging.info("Starting up...")
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    class_names = [None, 'bottle', 'box', 'bag']
+    profile = worker_threading_profile(1, 0, args.intra_op_threads, args.inter_op_threads, args.pin_cores)
+    model = ClomaskModel(class_names=class_names, batch_size=args.batch_size, frozen_graph=args.frozen_graph, cascade=args.cascade,
+                         adaptive_resolution=args.adaptive_resolution, **profile)
+    model.load(args.weights)
+
+    logging.info("Loaded model with batch size %d", args.batch_size)
+
+    batcher = DynamicBatcher(model, args.batch_size, args.max_latency).start()
+    server = ThreadingHTTPServer(("", args.port), make_handler(model, batcher, args.reduced_decode))
+    logging.info("Serving on port %d", args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,120 @@
+"""Latency and throughput metrics for the model server
+
+Stage latencies are recorded into histograms, and events (images, instances,
+failures) into counters. Both are exposed over HTTP in the Prometheus text
+format, so that percentiles can be computed from the histogram buckets:
+
+    curl localhost:9100/metrics
+"""
+
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import time
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+
+
+class Histogram:
+    """A cumulative histogram of observed values, with fixed bucket bounds"""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Yield (upper bound, number of observations <= upper bound) pairs"""
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """A thread safe registry of stage latency histograms and event counters"""
+    def __init__(self, prefix="clomask"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    def inc(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextmanager
+    def timed(self, stage):
+        """Record the time spent in the with block under stage"""
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time() - start)
+
+    def render(self):
+        """Render the metrics in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            name = self.prefix + "_stage_seconds"
+            lines.append("# TYPE {} histogram".format(name))
+            for stage, histogram in sorted(self.histograms.items()):
+                for bound, count in histogram.cumulative_counts():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, le, count))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, histogram.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, histogram.count))
+
+            for counter, value in sorted(self.counters.items()):
+                name = "{}_{}_total".format(self.prefix, counter)
+                lines.append("# TYPE {} counter".format(name))
+                lines.append("{} {}".format(name, value))
+
+        return "\n".join(lines) + "\n"
+
+
+# The registry that the server records into
+METRICS = Metrics()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, metrics=METRICS):
+    """Serve the metrics on http://0.0.0.0:port/metrics from a background thread"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logging.info("Serving metrics on port %d", port)
+    return server
@@ -3,12 +3,20 @@
     2. Download the image
     3. Run the model's predict method to create the mask
     4. Upload the mask.
+
+Messages are collected into batches of up to --batch-size images, so that
+the model runs detection on several images at once.
 """
 import os
 import sys
 import json
-from time import sleep
+import shutil
+import tempfile
+from time import time, sleep
 import logging
+from argparse import ArgumentParser
+from functools import partial
+from queue import Queue
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s [%(process)d] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -18,32 +26,80 @@ sys.path.extend([
     abspath("mrcnn/scripts")
 ])
 
-import boto3
+import skimage.io
 
 from .config import *
+from .pipeline import Stage, BatchStage
+from .supervisor import supervise, worker_threading_profile
+from .cache import ResultCache
+from .backends import make_backends, make_s3_event
+from .metrics import METRICS, start_metrics_server
 from ..models import ClomaskModel
+from ..models.v2.clomask_model import CLOMASK_MODEL_PATH
+from ..imutils import decode_image, encode_image, image_shape
 
-SQS_QUEUE = boto3.resource("sqs").Queue(SQS_URL)
-INPUT_S3_BUCKET = boto3.resource("s3").Bucket(INPUT_S3_BUCKET_NAME)
-OUTPUT_S3_BUCKET = boto3.resource("s3").Bucket(OUTPUT_S3_BUCKET_NAME)
-
-DOWNLOAD_DIR = "downloads"
-OUTPUT_DIR = "output"
+# Jobs that run on disk each get a directory of their own in here, for the
+# downloaded image and its outputs. Images with the same name are often in
+# flight at once, and must not overwrite or remove each other's files.
+JOBS_DIR = "jobs"
 
 # How long should we wait if the queue is empty
 SLEEP_TIME_IN_SEC = 2
 
-def s3_image_key_gen():
+# How often to poll the queue in the last second before a batch is due. Long
+# polls only wait for whole seconds, and would overshoot the deadline.
+SHORT_POLL_INTERVAL_IN_SEC = 0.1
+
+def parse_message(message):
+    """Extract the S3 object key from an S3 event notification"""
+    m_dict = json.loads(message.body)
+    logging.debug(m_dict)
+    obj_key = m_dict["Records"][0]["s3"]["object"]["key"]
+    return obj_key.replace("+", " ")
+
+
+def s3_image_key_batch_gen(queue, batch_size, max_wait, heartbeat=None):
+    """Yield batches of (S3 key, receipt handle) pairs read off the queue
+
+    A batch is yielded once it has batch_size messages, or max_wait seconds
+    after its first message arrived, whichever comes first. If provided,
+    heartbeat is called after every poll of the queue.
+
+    The time each message waits for its batch to fill up is recorded as receive_wait.
+    """
     while True:
-        messages = SQS_QUEUE.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=SLEEP_TIME_IN_SEC)
-        logging.info("Received %d messages", len(messages))
+        batch = []
+        received_at = []
+        deadline = None
+        while len(batch) < batch_size:
+            if deadline is None:
+                wait = SLEEP_TIME_IN_SEC
+            else:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                wait = min(SLEEP_TIME_IN_SEC, int(remaining))
+
+            max_messages = min(10, batch_size - len(batch))
+            messages = queue.receive(max_messages, wait)
+            logging.info("Received %d messages", len(messages))
+            if not messages and wait == 0:
+                sleep(min(SHORT_POLL_INTERVAL_IN_SEC, max(0, deadline - time())))
+
+            if heartbeat:
+                heartbeat()
 
-        for message in messages:
-            m_dict = json.loads(message.body)
-            logging.debug(m_dict)
-            obj_key = m_dict["Records"][0]["s3"]["object"]["key"]
-            obj_key = obj_key.replace("+", " ")
-            yield obj_key, message.receipt_handle
+            if messages and deadline is None:
+                deadline = time() + max_wait
+
+            batch.extend((parse_message(message), message.receipt_handle) for message in messages)
+            received_at.extend([time()] * len(messages))
+
+        now = time()
+        for t in received_at:
+            METRICS.observe("receive_wait", now - t)
+
+        yield batch
 
 
 def make_key(filename):
@@ -51,52 +107,351 @@ def make_key(filename):
     parent_dir = os.path.basename(os.path.dirname(filename))
     return parent_dir + "/" + just_file
 
-def main():
+
+class Job:
+    """The state of a single image as it moves through the server
+
+    In memory jobs keep the downloaded and rendered images as bytes, and
+    never touch the disk. Other jobs keep them in a directory of their own,
+    created in jobs_dir. Cached jobs skip detection and rendering, and
+    upload the outputs from the result cache instead.
+    """
+    def __init__(self, s3_image_key, receipt_handle, in_memory=False, jobs_dir=JOBS_DIR):
+        self.s3_image_key = s3_image_key
+        self.receipt_handle = receipt_handle
+        self.in_memory = in_memory
+        self.jobs_dir = jobs_dir
+        self.work_dir = None
+        self.download_path = None
+        self.data = None
+        self.image = None
+        self.shape = None
+        self.result = None
+        self.cache_key = None
+        self.cached = False
+        self.output_files = []
+        self.outputs = []
+
+    @property
+    def output_dir(self):
+        return os.path.join(self.work_dir, "output")
+
+    @property
+    def basename(self):
+        return os.path.basename(self.s3_image_key)
+
+    def output_key(self, label):
+        """The S3 key of the output labelled label, i.e. a class id, 'all' or 'json'"""
+        if label == "json":
+            return "json/" + os.path.splitext(self.basename)[0] + ".json"
+        return label + "/" + self.basename
+
+
+def download_job(store, job, cache=None, max_dim=None):
+    """Download and decode the image of a job
+
+    If max_dim is provided, JPEGs are decoded at a reduced size, whose longest
+    side is no smaller than max_dim. job.shape is the size of the original.
+    """
+    with METRICS.timed("download"):
+        if job.in_memory:
+            job.data = data = store.download_bytes(job.s3_image_key)
+        else:
+            job.work_dir = tempfile.mkdtemp(prefix="job-", dir=job.jobs_dir)
+            job.download_path = os.path.join(job.work_dir, job.basename)
+            store.download(job.s3_image_key, job.download_path)
+    if (cache or max_dim) and not job.in_memory:
+        with open(job.download_path, "rb") as f:
+            data = f.read()
+    logging.info("Downloaded %s from S3", job.s3_image_key)
+
+    if cache:
+        job.cache_key = cache.key(data, job.basename)
+        cached = cache.get(job.cache_key)
+        if cached is not None:
+            job.cached = True
+            job.outputs = [(job.output_key(label), output) for label, output in cached]
+            METRICS.inc("cache_hits")
+            logging.info("Found the outputs for %s in the result cache", job.s3_image_key)
+            return job
+
+    with METRICS.timed("decode"):
+        if job.in_memory or max_dim:
+            job.image = decode_image(data, max_dim)
+            job.shape = image_shape(data)
+        else:
+            job.image = skimage.io.imread(job.download_path)
+            job.shape = job.image.shape[:2]
+    return job
+
+
+def detect_jobs(model, jobs):
+    pending = [job for job in jobs if not job.cached]
+    if pending:
+        timings = {}
+        # Sparse masks take memory in proportion to the objects, not to the image
+        results = model.detect([job.image for job in pending], timings=timings, sparse_masks=True)
+        for step, seconds in timings.items():
+            METRICS.observe(step, seconds)
+        for job, result in zip(pending, results):
+            job.result = result
+            METRICS.inc("instances", len(result['class_ids']))
+        logging.info("Ran detection on %d images", len(pending))
+    METRICS.inc("images", len(jobs))
+    return jobs
+
+
+def render_job(model, job, cache=None, mask_format=None):
+    """Render the masks of a job, or encode its detections as JSON if mask_format is provided"""
+    if job.cached:
+        return job
+
+    with METRICS.timed("render"):
+        if mask_format and job.in_memory:
+            result = json.dumps(model.encode_result(job.result, mask_format, job.shape)).encode()
+            labelled = [("json", result)]
+            job.outputs = [(job.output_key(label), output) for label, output in labelled]
+        elif mask_format:
+            job.output_files = [model.save_result(job.download_path, job.result, job.output_dir, mask_format, job.shape)]
+        elif job.in_memory:
+            masks = model.render_masks(job.image, job.result, generate_per_class=True)
+            labelled = [(str(class_id), encode_image(mask, job.basename)) for class_id, mask in masks]
+            job.outputs = [(job.output_key(label), output) for label, output in labelled]
+        else:
+            job.output_files = model.save_masks(job.download_path, job.image, job.result, job.output_dir, generate_per_class=True)
+
+    if cache and not job.in_memory:
+        labelled = []
+        for output_file in job.output_files:
+            with open(output_file, "rb") as f:
+                labelled.append((os.path.basename(os.path.dirname(output_file)), f.read()))
+
+    # Release the image and the masks as early as possible
+    job.image = job.result = None
+    logging.info("Created %s for %s", "detections" if mask_format else "masks", job.s3_image_key)
+
+    if cache:
+        cache.put(job.cache_key, labelled)
+
+    return job
+
+
+def upload_job(store, queue, job):
+    with METRICS.timed("upload"):
+        # The downloaded image doubles as the original, so it doesn't need to be copied
+        og_key = "og/" + job.basename
+        if job.in_memory:
+            store.upload_bytes(job.data, og_key)
+        else:
+            store.upload(job.download_path, og_key)
+
+        for key, output in job.outputs:
+            store.upload_bytes(output, key)
+        for output_file in job.output_files:
+            store.upload(output_file, make_key(output_file))
+    logging.info("Uploaded %s to S3", job.s3_image_key)
+
+    cleanup_job(job)
+
+    # Delete from queue, so that we don't reprocess it
+    with METRICS.timed("delete"):
+        queue.delete([job.receipt_handle])
+    logging.info("Successfully processed image %s with handle %s", job.s3_image_key, job.receipt_handle)
+
+
+def cleanup_job(job, error=None):
+    """Remove the directory of a job, along with its local files
+
+    Failed jobs are not deleted from the queue, so they will be retried once
+    their visibility timeout expires.
+    """
+    if error is not None:
+        METRICS.inc("failures")
+
+    if job.work_dir:
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        job.work_dir = None
+
+
+def cleanup_jobs(jobs, error=None):
+    for job in jobs:
+        cleanup_job(job, error)
+
+
+def run_jobs(step, jobs):
+    """Run step on each job, and return the jobs that it succeeded for
+
+    Jobs that fail are logged, counted and cleaned up, and left out of the
+    later steps, so that one bad image doesn't fail the rest of its batch.
+    """
+    done = []
+    for job in jobs:
+        try:
+            step(job)
+        except Exception as e:
+            logging.exception("Failed to process %s", job.s3_image_key)
+            cleanup_job(job, e)
+        else:
+            done.append(job)
+    return done
+
+
+def detect_batch(model, jobs):
+    """Run detection on a batch of jobs, and return the jobs that it succeeded for
+
+    If detection fails for the batch, the jobs are run one at a time, so that
+    only the ones whose images fail it are cleaned up, see run_jobs.
+    """
+    if len(jobs) > 1:
+        try:
+            return detect_jobs(model, jobs)
+        except Exception:
+            logging.exception("Failed to run detection on %d images, running them one at a time", len(jobs))
+
+    return run_jobs(lambda job: detect_jobs(model, [job]), jobs)
+
+
+def process_batch(model, backends, jobs, cache=None, mask_format=None, max_dim=None):
+    """Create and upload the masks for a batch of jobs, one step at a time"""
+    logging.info("Processing %d images", len(jobs))
+
+    jobs = run_jobs(partial(download_job, backends.input_store, cache=cache, max_dim=max_dim), jobs)
+
+    # Get the mask predictions for the whole batch at once
+    jobs = detect_batch(model, jobs)
+
+    run_jobs(lambda job: upload_job(backends.output_store, backends.queue, render_job(model, job, cache, mask_format)), jobs)
+
+
+def run_pipeline(model, backends, args, cache=None, heartbeat=None, max_dim=None, jobs_dir=JOBS_DIR):
+    """Run the server as a pipeline of download, inference, render and upload stages
+
+    Downloads and uploads run in their own thread pools, so that network I/O
+    overlaps with inference. Only the (single threaded) inference stage uses the model.
+    """
+    download_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    infer_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    render_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    upload_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    stages = [
+        Stage("download", partial(download_job, backends.input_store, cache=cache, max_dim=max_dim), download_queue, infer_queue,
+              workers=DOWNLOAD_WORKERS, on_error=cleanup_job),
+        BatchStage("infer", partial(detect_batch, model), infer_queue, render_queue,
+                   on_error=cleanup_jobs, batch_size=args.batch_size, max_wait=args.max_wait),
+        Stage("render", partial(render_job, model, cache=cache, mask_format=args.mask_format), render_queue, upload_queue,
+              workers=RENDER_WORKERS, on_error=cleanup_job),
+        Stage("upload", partial(upload_job, backends.output_store, backends.queue), upload_queue,
+              workers=UPLOAD_WORKERS, on_error=cleanup_job),
+    ]
+    for stage in stages:
+        stage.start()
+
+    # Indefinite loop to feed messages from the queue into the pipeline.
+    # This blocks while the pipeline is full, so we don't hold on to more
+    # messages than we can process.
+    for batch in s3_image_key_batch_gen(backends.queue, 10, 0, heartbeat):
+        for s3_image_key, receipt_handle in batch:
+            download_queue.put(Job(s3_image_key, receipt_handle, args.in_memory, jobs_dir))
+
+
+def parse_args():
+    """Parse arguments from the command line"""
+    parser = ArgumentParser(description="Serve the Clomask model over SQS and S3")
+    parser.add_argument("--backend", required=False, choices=["aws", "local"], default="aws", help="Serve from SQS and S3, or from local directories that stand in for them")
+    parser.add_argument("--local-dir", required=False, default=LOCAL_DIR, help="The root directory of the local backend")
+    parser.add_argument("--enqueue-inputs", action="store_true", help="With the local backend, enqueue every image in the input directory on startup")
+    parser.add_argument("--batch-size", required=False, type=int, default=BATCH_SIZE, help="The maximum number of images to run through the model at once")
+    parser.add_argument("--weights", required=False, default=CLOMASK_MODEL_PATH, help="The h5 weights to load, or a weight store converted from them by convert_weights")
+    resolution = parser.add_mutually_exclusive_group()
+    resolution.add_argument("--cascade", action="store_true", help="Detect at a low resolution first, and at full resolution only the images with many, small or uncertain detections")
+    resolution.add_argument("--adaptive-resolution", action="store_true", help="Detect each image at a resolution picked from its size and sharpness, instead of at 1024")
+    parser.add_argument("--frozen-graph", required=False, default=None, help="Run this graph, exported by export_graph with the same batch size, instead of building the model")
+    parser.add_argument("--max-wait", required=False, type=float, default=BATCH_MAX_WAIT_IN_SEC, help="How long (in seconds) to wait for a batch to fill up once its first message arrives")
+    parser.add_argument("--pipeline", action="store_true", help="Run downloads, inference, rendering and uploads as concurrent stages")
+    parser.add_argument("--in-memory", action="store_true", help="Keep downloaded and generated images in memory instead of writing them to disk")
+    parser.add_argument("--reduced-decode", action="store_true", help="Decode JPEGs straight to the (smaller) size that the model needs, instead of at full size")
+    parser.add_argument("--mask-format", required=False, choices=["rle", "polygon"], default=None, help="Upload the detections as JSON, with masks in this format, instead of rendering them")
+    parser.add_argument("--cache-dir", required=False, default=None, help="Cache the outputs for each distinct image in this directory. Disabled if not provided")
+    parser.add_argument("--cache-size-mb", required=False, type=int, default=RESULT_CACHE_SIZE_MB, help="The size of the result cache above which the least recently used outputs are evicted")
+    parser.add_argument("--metrics-port", required=False, type=int, default=METRICS_PORT, help="Serve latency and throughput metrics on this port (0 to disable). Workers use consecutive ports")
+    parser.add_argument("--workers", required=False, type=int, default=WORKERS, help="The number of worker processes, each with its own copy of the model")
+    parser.add_argument("--intra-op-threads", required=False, type=int, default=WORKER_INTRA_OP_THREADS, help="TensorFlow intra-op threads per worker. Defaults to an even split of the cores")
+    parser.add_argument("--inter-op-threads", required=False, type=int, default=WORKER_INTER_OP_THREADS, help="TensorFlow inter-op threads per worker")
+    parser.add_argument("--pin-cores", action="store_true", help="Pin each worker to its own cores, as many as its intra-op threads")
+
+    args = parser.parse_args()
+    if args.enqueue_inputs and args.backend != "local":
+        parser.error("--enqueue-inputs requires --backend local")
+
+    return args
+
+
+def serve(args, heartbeat=None, worker_index=0):
+    """Load the model and process messages off the queue indefinitely
+
+    If provided, heartbeat is called regularly while the server is healthy.
+    Each worker serves its metrics on its own port, offset by worker_index.
+    """
     logging.info("Starting up...")
 
-    if not os.path.exists(DOWNLOAD_DIR):
-        os.mkdir(DOWNLOAD_DIR)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port + worker_index)
+
+    backends = make_backends(args.backend, args.local_dir)
 
-    # Create the output dir if it doesn't exist
-    if not os.path.exists(OUTPUT_DIR):
-        os.mkdir(OUTPUT_DIR)
+    # Each worker keeps its jobs in a directory of its own. The supervisor stops a
+    # worker before restarting it, so whatever is left in there was abandoned.
+    jobs_dir = os.path.join(JOBS_DIR, "worker-{}".format(worker_index))
+    shutil.rmtree(jobs_dir, ignore_errors=True)
+    os.makedirs(jobs_dir)
 
     class_names = [None, 'bottle', 'box', 'bag']
-    model = ClomaskModel(class_names=class_names)
-    model.load()
+    profile = worker_threading_profile(args.workers, worker_index, args.intra_op_threads, args.inter_op_threads, args.pin_cores)
+    model = ClomaskModel(class_names=class_names, batch_size=args.batch_size, frozen_graph=args.frozen_graph, cascade=args.cascade,
+                         adaptive_resolution=args.adaptive_resolution, **profile)
+    model.load(args.weights)
 
-    logging.info("Loaded model")
+    logging.info("Loaded model with batch size %d, %d intra-op and %d inter-op threads", args.batch_size,
+                 profile["intra_op_threads"], profile["inter_op_threads"])
 
-    # Indefinite loop to listen to messages on the queue
-    for s3_image_key, receipt_handle in s3_image_key_gen():
-        logging.info("Processing image %s with handle %s", s3_image_key, receipt_handle)
+    cache = None
+    if args.cache_dir:
+        # The outputs depend on the output format and the decoding as well as on the model
+        namespace = "-".join([model.fingerprint(), args.mask_format or "render", "reduced" if args.reduced_decode else "full"])
+        cache = ResultCache(args.cache_dir, args.cache_size_mb * 2**20, namespace)
+        logging.info("Using the result cache in %s", args.cache_dir)
+
+    max_dim = model.decode_max_dim if args.reduced_decode else None
 
-        download_path = os.path.join(DOWNLOAD_DIR, s3_image_key)
+    if args.pipeline:
+        run_pipeline(model, backends, args, cache, heartbeat, max_dim, jobs_dir)
+        return
+
+    # Indefinite loop to listen to messages on the queue
+    for batch in s3_image_key_batch_gen(backends.queue, args.batch_size, args.max_wait, heartbeat):
+        jobs = [Job(s3_image_key, receipt_handle, args.in_memory, jobs_dir) for s3_image_key, receipt_handle in batch]
+        # Failures are handled one job at a time, see run_jobs
+        process_batch(model, backends, jobs, cache, args.mask_format, max_dim)
 
-        # Pick up the image from S3
-        INPUT_S3_BUCKET.download_file(Key=s3_image_key, Filename=download_path)
-        logging.info("Downloaded %s from S3", s3_image_key)
 
-        # Get the mask predictions and annotations
-        output_files = model.create_mask(download_path, OUTPUT_DIR, generate_per_class=True)
-        logging.info("Created mask for %s", s3_image_key)
+def enqueue_inputs(backends):
+    """Enqueue an S3 event for every image in the (local) input store"""
+    keys = list(backends.input_store.keys())
+    for key in keys:
+        backends.queue.send(make_s3_event(key))
+    logging.info("Enqueued %d local images", len(keys))
 
-        # Upload to output S3 bucket
-        for output_file in output_files:
-            key = make_key(output_file)
-            OUTPUT_S3_BUCKET.upload_file(Filename=output_file, Key=key)
-        logging.info("Uploaded %s to S3", s3_image_key)
 
-        # Cleanup files
-        os.remove(download_path)
-        for output_file in output_files:
-            os.remove(output_file)
-        logging.info("Cleaned up local files")
+def main(args):
+    if args.enqueue_inputs:
+        enqueue_inputs(make_backends(args.backend, args.local_dir))
 
-        # Delete from queue, so that we don't reprocess it
-        SQS_QUEUE.delete_messages(Entries=[{'Id': 'dummy', 'ReceiptHandle': receipt_handle}])
-        logging.info("Successfully processed image %s with handle %s", s3_image_key, receipt_handle)
+    if args.workers > 1:
+        supervise(serve, args)
+    else:
+        serve(args)
 
 
 if __name__ == "__main__":
-    main()
+    main(parse_args())
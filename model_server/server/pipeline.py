@@ -0,0 +1,108 @@
+"""Building blocks for running the model server as a staged pipeline
+
+Each stage is a pool of threads that reads items off an input queue, applies
+a function to them, and puts the results on the queue of the next stage.
+Queues are bounded, so a slow stage applies back pressure to the ones before it
+instead of letting work pile up in memory.
+"""
+
+import logging
+import threading
+from queue import Empty
+from time import time
+
+
+class Stage:
+    """A pool of worker threads that apply a function to each item of a queue
+
+    Arguments
+    ---------
+    name: str
+        A human readable name, used for thread names and logging
+
+    fn: callable
+        Called with a single item from the inbox. Its return value is put on the
+        outbox, unless it is None.
+
+    inbox: queue.Queue
+        The queue this stage reads from
+
+    outbox: queue.Queue, optional
+        The queue this stage writes to. If not provided, results are discarded.
+
+    workers: int, default=1
+        The number of threads that run fn concurrently
+
+    on_error: callable, optional
+        Called with the item and the exception if fn raises, so that the item
+        can be cleaned up. The exception is always logged.
+    """
+    def __init__(self, name, fn, inbox, outbox=None, workers=1, on_error=None):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.workers = workers
+        self.on_error = on_error
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name="{}-{}".format(self.name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        return self
+
+    def _next(self):
+        return self.inbox.get()
+
+    def _run(self):
+        while True:
+            item = self._next()
+            try:
+                result = self.fn(item)
+            except Exception as e:
+                logging.exception("Stage %s failed", self.name)
+                if self.on_error:
+                    self.on_error(item, e)
+                continue
+
+            if self.outbox is not None and result is not None:
+                self._emit(result)
+
+    def _emit(self, result):
+        self.outbox.put(result)
+
+
+class BatchStage(Stage):
+    """A stage whose function is called with lists of items
+
+    A batch is handed to the function once it has batch_size items, or max_wait
+    seconds after its first item arrived, whichever comes first. The function
+    should return a list, whose items are put on the outbox one by one. on_error,
+    if provided, is called with the whole batch.
+    """
+    def __init__(self, name, fn, inbox, outbox=None, workers=1, on_error=None, batch_size=1, max_wait=0):
+        super().__init__(name, fn, inbox, outbox, workers, on_error)
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+    def _next(self):
+        batch = [self.inbox.get()]
+        deadline = time() + self.max_wait
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.inbox.get(timeout=remaining))
+            except Empty:
+                break
+
+        return batch
+
+    def _emit(self, result):
+        for item in result:
+            self.outbox.put(item)
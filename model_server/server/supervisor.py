@@ -0,0 +1,156 @@
+"""Run the model server as several worker processes
+
+Each worker is a separate Python process with its own copy of the model, and its
+own (smaller) TensorFlow thread pools, so that the CPU bound parts of the server
+that hold the GIL can run in parallel. The workers share the work by reading off
+the same SQS queue.
+
+Workers report a heartbeat while they are polling the queue. The supervisor
+restarts workers that die, or whose heartbeat goes stale.
+"""
+
+import os
+import logging
+import multiprocessing
+from time import time, sleep
+
+from .config import *
+
+
+def worker_threading_profile(workers, index, intra_op_threads=0, inter_op_threads=WORKER_INTER_OP_THREADS, pin_cores=False):
+    """The threading profile of one of several workers that share this machine
+
+    Arguments
+    ---------
+    workers: int
+        The number of workers
+
+    index: int
+        The index of the worker, from 0 to workers - 1
+
+    intra_op_threads: int
+        The intra-op threads of each worker. 0 splits the cores evenly between the workers.
+
+    inter_op_threads: int
+        The inter-op threads of each worker
+
+    pin_cores: bool
+        Whether to pin each worker to its own intra_op_threads cores, so that the
+        workers don't compete for the same cores
+
+    Return
+    ------
+    The intra-op threads, inter-op threads and the cores (None if not pinned) of the worker,
+    as keyword arguments of the model
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(multiprocessing.cpu_count()))
+    intra_op_threads = intra_op_threads or max(1, len(cores) // workers)
+
+    cpu_affinity = None
+    if pin_cores:
+        start = (index * intra_op_threads) % len(cores)
+        cpu_affinity = [cores[(start + i) % len(cores)] for i in range(min(intra_op_threads, len(cores)))]
+
+    return dict(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads, cpu_affinity=cpu_affinity)
+
+
+def _run_worker(target, args, index, heartbeat):
+    def beat():
+        heartbeat.value = time()
+
+    target(args, heartbeat=beat, worker_index=index)
+
+
+class Worker:
+    """A worker process, along with what the supervisor knows about its health"""
+    def __init__(self, index, target, args, context):
+        self.index = index
+        self.target = target
+        self.args = args
+        self.context = context
+        self.heartbeat = context.Value('d', 0.0)
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+
+    def start(self):
+        # A heartbeat of 0 means that the worker is still loading the model
+        self.heartbeat.value = 0.0
+        self.process = self.context.Process(
+            target=_run_worker,
+            args=(self.target, self.args, self.index, self.heartbeat),
+            name="worker-{}".format(self.index)
+        )
+        self.process.start()
+        self.started_at = time()
+        logging.info("Started worker %d with pid %d", self.index, self.process.pid)
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(WORKER_STOP_TIMEOUT_IN_SEC)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def health(self, now):
+        """Return None if the worker is healthy, or the reason why it isn't"""
+        if not self.process.is_alive():
+            return "exited with code {}".format(self.process.exitcode)
+
+        last_heartbeat = self.heartbeat.value
+        if not last_heartbeat:
+            if now - self.started_at > WORKER_STARTUP_TIMEOUT_IN_SEC:
+                return "did not start within {}s".format(WORKER_STARTUP_TIMEOUT_IN_SEC)
+        elif now - last_heartbeat > WORKER_HEARTBEAT_TIMEOUT_IN_SEC:
+            return "has not reported a heartbeat for {:.0f}s".format(now - last_heartbeat)
+
+        return None
+
+
+def supervise(target, args):
+    """Run target(args, heartbeat=..., worker_index=...) in args.workers processes, and keep them running
+
+    Arguments
+    ---------
+    target: callable
+        A module level function that serves requests indefinitely, and calls
+        heartbeat() regularly while it is healthy. worker_index is the index
+        of the worker, from 0 to args.workers - 1.
+
+    args: argparse.Namespace
+        The parsed command line arguments, passed on to target. The number of
+        workers is read from it. target reads the threading profile of its worker
+        from it as well, see worker_threading_profile.
+    """
+    # Don't fork, TensorFlow's state can not be safely shared with a child process
+    context = multiprocessing.get_context("spawn")
+
+    workers = [Worker(i, target, args, context) for i in range(args.workers)]
+
+    profile = worker_threading_profile(args.workers, 0, args.intra_op_threads, args.inter_op_threads)
+    logging.info("Starting %d workers with %d intra-op and %d inter-op threads each%s",
+                 args.workers, profile["intra_op_threads"], profile["inter_op_threads"],
+                 ", pinned to their own cores" if args.pin_cores else "")
+    for worker in workers:
+        worker.start()
+
+    try:
+        while True:
+            sleep(WORKER_CHECK_INTERVAL_IN_SEC)
+            now = time()
+            for worker in workers:
+                reason = worker.health(now)
+                if reason:
+                    logging.warning("Worker %d %s, restarting it (restarts so far: %d)",
+                                    worker.index, reason, worker.restarts)
+                    worker.restart()
+    finally:
+        logging.info("Stopping workers")
+        for worker in workers:
+            worker.stop()
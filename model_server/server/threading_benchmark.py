@@ -0,0 +1,117 @@
+"""Sweep threading profiles for throughput versus tail latency
+
+Runs the model in --workers processes at once (as the supervisor does), for
+every combination of the given worker counts and thread pool sizes, and
+reports the images per second of all workers together, and the median and
+99th percentile latency of a batch:
+
+    python3 -m model_server.server.threading_benchmark research/resolution/pixel/*.jpg \\
+        --workers 1 2 4 --inter-op-threads 1 2 --pin-cores
+
+Each worker's intra-op threads are an even split of the cores, unless
+--intra-op-threads is given.
+"""
+import os
+import sys
+import logging
+import multiprocessing
+from argparse import ArgumentParser
+from itertools import product
+from time import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s [%(process)d] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+abspath = os.path.abspath
+sys.path.extend([
+    abspath("mrcnn"),
+    abspath("mrcnn/scripts")
+])
+
+import numpy as np
+import skimage.io
+
+from .config import *
+from .supervisor import worker_threading_profile
+from ..models import ClomaskModel
+from ..models.v2.clomask_model import CLOMASK_MODEL_PATH
+
+
+def _run_worker(filepaths, batch_size, batches, weights, profile, ready, results):
+    """Load the model with profile, wait for the other workers, and time batches of detection"""
+    class_names = [None, 'bottle', 'box', 'bag']
+    model = ClomaskModel(class_names=class_names, batch_size=batch_size, **profile)
+    model.load(weights)
+
+    images = [skimage.io.imread(filepath)[:, :, :3] for filepath in filepaths]
+    batch = [images[i % len(images)] for i in range(batch_size)]
+    # Warm up, the first run is much slower
+    model.detect(batch)
+
+    ready.wait()
+    latencies = []
+    for _ in range(batches):
+        start = time()
+        model.detect(batch)
+        latencies.append(time() - start)
+    results.put(latencies)
+
+
+def benchmark(args, workers, intra_op_threads, inter_op_threads):
+    """Run one profile, and return the images per second and the batch latencies of all workers"""
+    # Spawn, as the supervisor does. The affinity and the thread pools are per process.
+    context = multiprocessing.get_context("spawn")
+    ready = context.Barrier(workers + 1)
+    results = context.Queue()
+
+    processes = []
+    for index in range(workers):
+        profile = worker_threading_profile(workers, index, intra_op_threads, inter_op_threads, args.pin_cores)
+        process = context.Process(target=_run_worker,
+                                  args=(args.images, args.batch_size, args.batches, args.weights, profile, ready, results))
+        process.start()
+        processes.append(process)
+
+    ready.wait()
+    start = time()
+    latencies = []
+    for _ in range(workers):
+        latencies.extend(results.get())
+    elapsed = time() - start
+
+    for process in processes:
+        process.join()
+
+    return workers * args.batches * args.batch_size / elapsed, np.array(latencies)
+
+
+def parse_args():
+    """Parse arguments from the command line"""
+    parser = ArgumentParser(description="Sweep threading profiles for images/sec versus p99 latency")
+    parser.add_argument("images", nargs="+", help="The images to run detection on")
+    parser.add_argument("--workers", required=False, type=int, nargs="+", default=[1, 2, 4], help="The numbers of worker processes to try")
+    parser.add_argument("--intra-op-threads", required=False, type=int, nargs="+", default=[0], help="The intra-op threads per worker to try. 0 splits the cores evenly")
+    parser.add_argument("--inter-op-threads", required=False, type=int, nargs="+", default=[1, 2], help="The inter-op threads per worker to try")
+    parser.add_argument("--pin-cores", action="store_true", help="Pin each worker to its own cores")
+    parser.add_argument("--batch-size", required=False, type=int, default=BATCH_SIZE, help="The number of images per batch")
+    parser.add_argument("--batches", required=False, type=int, default=20, help="The number of batches each worker times")
+    parser.add_argument("--weights", required=False, default=CLOMASK_MODEL_PATH, help="The weights to load, h5 or a weight store")
+
+    return parser.parse_args()
+
+
+def main(args):
+    rows = []
+    for workers, intra_op_threads, inter_op_threads in product(args.workers, args.intra_op_threads, args.inter_op_threads):
+        intra_op_threads = worker_threading_profile(workers, 0, intra_op_threads)["intra_op_threads"]
+        logging.info("Running %d workers with %d intra-op and %d inter-op threads", workers, intra_op_threads, inter_op_threads)
+        images_per_sec, latencies = benchmark(args, workers, intra_op_threads, inter_op_threads)
+        rows.append((workers, intra_op_threads, inter_op_threads, images_per_sec,
+                     np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+    print("{:>8} {:>8} {:>8} {:>12} {:>10} {:>10}".format("workers", "intra", "inter", "images/sec", "p50 (s)", "p99 (s)"))
+    for row in rows:
+        print("{:>8} {:>8} {:>8} {:>12.2f} {:>10.3f} {:>10.3f}".format(*row))
+
+
+if __name__ == "__main__":
+    main(parse_args())
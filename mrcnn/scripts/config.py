@@ -126,7 +126,8 @@ class Config(object):
     #         of size [max_dim, max_dim].
     # pad64:  Pads width and height with zeros to make them multiples of 64.
     #         If IMAGE_MIN_DIM or IMAGE_MIN_SCALE are not None, then it scales
-    #         up before padding. IMAGE_MAX_DIM is ignored in this mode.
+    #         up before padding. It then scales down, if needed, so that
+    #         the long side isn't > IMAGE_MAX_DIM.
     #         The multiple of 64 is needed to ensure smooth scaling of feature
     #         maps up and down the 6 levels of the FPN pyramid (2**6=64).
     # crop:   Picks random crops from the image. First, scales the image based
@@ -149,6 +150,19 @@ class Config(object):
     # Image mean (RGB)
     MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
 
+    # Mold inference inputs with OpenCV in uint8/float32, straight into a
+    # reusable batch buffer, instead of with scikit-image in float64. Much
+    # faster, and resized pixels differ by at most one level (OpenCV rounds
+    # where scikit-image truncates). Off by default, so that evaluation
+    # molds images exactly as before. Turned on in the inference configs
+    # of the model server.
+    FAST_MOLDING = False
+
+    # Number of image shapes to keep the anchors (and, with FAST_MOLDING, the
+    # molding buffers) of. Only "pad64" mode produces more than one shape.
+    ANCHOR_CACHE_SIZE = 64
+    MOLD_BUFFER_CACHE_SIZE = 4
+
     # Number of ROIs per image to feed to classifier/mask heads
     # The Mask RCNN paper uses 512 but often the RPN doesn't generate
     # enough positive proposals to fill this and keep a positive:negative
@@ -184,6 +198,18 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Two-stage cascade, see MaskRCNN.detect_cascade(). Images are detected at
+    # CASCADE_MAX_DIM first, and again at IMAGE_MAX_DIM only if they have at
+    # least CASCADE_MAX_INSTANCES detections, at least
+    # CASCADE_MAX_SMALL_INSTANCES with a side under CASCADE_SMALL_BOX_SIZE
+    # pixels (at CASCADE_MAX_DIM), or any with a score within
+    # CASCADE_SCORE_MARGIN of DETECTION_MIN_CONFIDENCE.
+    CASCADE_MAX_DIM = 512
+    CASCADE_MAX_INSTANCES = 20
+    CASCADE_MAX_SMALL_INSTANCES = 3
+    CASCADE_SMALL_BOX_SIZE = 16
+    CASCADE_SCORE_MARGIN = 0.05
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimizer
@@ -220,6 +246,16 @@ class Config(object):
     # Gradient norm clipping
     GRADIENT_CLIP_NORM = 5.0
 
+    # CPU threading profile of the session that the model runs in: the
+    # sizes of the TensorFlow intra-op (within an op, e.g. a convolution)
+    # and inter-op (independent ops at once) thread pools, and the cores
+    # that the process may run on. None keeps the TensorFlow default of
+    # using all cores, which oversubscribes the CPU when several processes
+    # run models on the same machine.
+    INTRA_OP_THREADS = None
+    INTER_OP_THREADS = None
+    CPU_AFFINITY = None
+
     def __init__(self):
         """Set values of computed attributes."""
         # Effective batch size
@@ -12,6 +12,7 @@ import sys
 import glob
 import random
 import math
+import time
 import datetime
 import itertools
 import json
@@ -1831,6 +1832,27 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 #  MaskRCNN Class
 ############################################################
 
+def apply_threading_profile(config):
+    """Applies the CPU threading profile of a config to this process.
+
+    Pins the process to the cores in CPU_AFFINITY, if set, and returns a
+    tf.ConfigProto with the INTRA_OP_THREADS and INTER_OP_THREADS thread
+    pool sizes, or None if both are left to TensorFlow. Must be called
+    before the session is created, so that its threads inherit the
+    affinity.
+    """
+    if config.CPU_AFFINITY is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, config.CPU_AFFINITY)
+    if config.INTRA_OP_THREADS is None and config.INTER_OP_THREADS is None:
+        return None
+    if config.INTRA_OP_THREADS:
+        # Also sizes the OpenMP pool of MKL builds of TensorFlow
+        os.environ["OMP_NUM_THREADS"] = str(config.INTRA_OP_THREADS)
+    return tf.ConfigProto(
+        intra_op_parallelism_threads=config.INTRA_OP_THREADS or 0,
+        inter_op_parallelism_threads=config.INTER_OP_THREADS or 0)
+
+
 class MaskRCNN():
     """Encapsulates the Mask RCNN model functionality.
 
@@ -1848,6 +1870,9 @@ class MaskRCNN():
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
+        session_config = apply_threading_profile(config)
+        if session_config is not None:
+            K.set_session(tf.Session(config=session_config))
         self.keras_model = self.build(mode=mode, config=config)
 
     def build(self, mode, config):
@@ -2111,7 +2136,13 @@ class MaskRCNN():
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exclude: list of layer names to exclude
+
+        filepath can also be a weight store (see utils.convert_h5_weights),
+        which is loaded by name with load_weight_store().
         """
+        if utils.is_weight_store(filepath):
+            return self.load_weight_store(filepath, exclude)
+
         import h5py
         # Conditional import to support versions of Keras before 2.2
         # TODO: remove in about 6 months (end of 2018)
@@ -2150,6 +2181,48 @@ class MaskRCNN():
         # Update the log directory
         self.set_log_dir(filepath)
 
+    def load_weight_store(self, store_path, exclude=None):
+        """Loads weights by name from a weight store. The result is the same
+        as that of load_weights(by_name=True) with the h5 file that the store
+        was converted from, but the weights are memory-mapped rather than
+        parsed, so loading takes less time and memory. They are copied into
+        the model's variables, so the store isn't needed once loaded.
+
+        store_path: a directory written by utils.convert_h5_weights()
+        exclude: list of layer names to exclude
+        """
+        store = utils.load_weight_store(store_path)
+        self.set_weights_by_name(
+            {name: [value for _, value in weights] for name, weights in store.items()},
+            exclude)
+
+        # Update the log directory
+        self.set_log_dir(store_path)
+
+    def set_weights_by_name(self, weights, exclude=None):
+        """Sets the weights of layers by name, in a single batch.
+        weights: dict of layer name to the list of values of its weights,
+            e.g. from utils.load_weight_store(). Layers that are not in it
+            are left as they are.
+        exclude: list of layer names to exclude
+        """
+        # In multi-GPU training, we wrap the model. Get layers
+        # of the inner model because they have the weights.
+        keras_model = self.keras_model
+        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
+            else keras_model.layers
+
+        weight_value_tuples = []
+        for layer in layers:
+            if layer.name not in weights or (exclude and layer.name in exclude):
+                continue
+            values = weights[layer.name]
+            if len(values) != len(layer.weights):
+                raise ValueError("Layer {} expects {} weights, but got {}".format(
+                    layer.name, len(layer.weights), len(values)))
+            weight_value_tuples += zip(layer.weights, values)
+        K.batch_set_value(weight_value_tuples)
+
     def get_imagenet_weights(self):
         """Downloads ImageNet trained weights from Keras.
         Returns path to weights file.
@@ -2394,18 +2467,27 @@ class MaskRCNN():
         )
         self.epoch = max(self.epoch, epochs)
 
-    def mold_inputs(self, images):
+    def mold_inputs(self, images, max_dim=None):
         """Takes a list of images and modifies them to the format expected
         as an input to the neural network.
         images: List of image matrices [height,width,depth]. Images can have
             different sizes.
+        max_dim: Optional. Overrides IMAGE_MAX_DIM (and caps IMAGE_MIN_DIM),
+            e.g. to run the model at a lower resolution. See resize_dims().
 
         Returns 3 Numpy matrices:
         molded_images: [N, h, w, 3]. Images resized and normalized.
         image_metas: [N, length of meta data]. Details about each image.
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
+
+        With config.FAST_MOLDING, molded_images is a view of a buffer that
+        is reused by the next call with the same molded shape.
         """
+        if self.config.FAST_MOLDING and self.config.IMAGE_RESIZE_MODE != "crop":
+            return self.mold_inputs_fast(images, max_dim)
+
+        min_dim, max_dim = self.resize_dims(max_dim)
         molded_images = []
         image_metas = []
         windows = []
@@ -2414,9 +2496,9 @@ class MaskRCNN():
             # TODO: move resizing to mold_image()
             molded_image, window, scale, padding, crop = utils.resize_image(
                 image,
-                min_dim=self.config.IMAGE_MIN_DIM,
+                min_dim=min_dim,
                 min_scale=self.config.IMAGE_MIN_SCALE,
-                max_dim=self.config.IMAGE_MAX_DIM,
+                max_dim=max_dim,
                 mode=self.config.IMAGE_RESIZE_MODE)
             molded_image = mold_image(molded_image, self.config)
             # Build image_meta
@@ -2433,8 +2515,116 @@ class MaskRCNN():
         windows = np.stack(windows)
         return molded_images, image_metas, windows
 
+    def mold_inputs_fast(self, images, max_dim=None):
+        """Like mold_inputs(), but resizes with OpenCV in the images' own
+        dtype, and writes the normalized images straight into a float32
+        batch buffer that is allocated once per molded shape and reused
+        across calls.
+
+        All images must have the same shape after resizing and padding,
+        which is always the case in "square" mode.
+        """
+        config = self.config
+        mean_pixel = np.asarray(config.MEAN_PIXEL, dtype=np.float32)
+
+        # Work out the resizing and padding of every image first
+        layouts = [self.mold_layout(image.shape, max_dim) for image in images]
+
+        molded_shape = layouts[0][3]
+        assert all(layout[3] == molded_shape for layout in layouts),\
+            "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
+
+        # Reuse the buffer of a previous call with this shape if it's big
+        # enough. Only the buffers of the latest MOLD_BUFFER_CACHE_SIZE
+        # shapes are kept, as pad64 mode can produce many shapes.
+        if not hasattr(self, "_mold_buffers"):
+            self._mold_buffers = OrderedDict()
+        buffer = self._mold_buffers.pop(molded_shape, None)
+        if buffer is None or buffer.shape[0] < len(images):
+            buffer = np.empty((max(len(images), config.BATCH_SIZE),) + molded_shape, dtype=np.float32)
+        self._mold_buffers[molded_shape] = buffer
+        while len(self._mold_buffers) > config.MOLD_BUFFER_CACHE_SIZE:
+            self._mold_buffers.popitem(last=False)
+
+        image_metas = []
+        windows = []
+        for i, (image, (scale, (h, w), window, _)) in enumerate(zip(images, layouts)):
+            if scale > 1:
+                # Upscaling samples beyond the edges of the image, which
+                # scikit-image treats as 0s (mode="constant"). cv2.resize
+                # replicates the edge pixels instead, so warp with a constant
+                # border, along the same pixel grid as resize().
+                sy, sx = image.shape[0] / h, image.shape[1] / w
+                transform = np.array([[sx, 0, (sx - 1) / 2], [0, sy, (sy - 1) / 2]])
+                resized = cv2.warpAffine(
+                    image, transform, (w, h),
+                    flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                    borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            elif scale != 1:
+                resized = cv2.resize(image, (w, h), interpolation=cv2.INTER_LINEAR)
+            else:
+                resized = image
+            y1, x1, y2, x2 = window
+            # The padding is 0 before normalization, i.e. -MEAN_PIXEL after
+            buffer[i, :y1] = -mean_pixel
+            buffer[i, y2:] = -mean_pixel
+            buffer[i, y1:y2, :x1] = -mean_pixel
+            buffer[i, y1:y2, x2:] = -mean_pixel
+            region = buffer[i, y1:y2, x1:x2]
+            region[...] = resized
+            region -= mean_pixel
+
+            image_metas.append(compose_image_meta(
+                0, image.shape, molded_shape, window, scale,
+                np.zeros([config.NUM_CLASSES], dtype=np.int32)))
+            windows.append(window)
+
+        return buffer[:len(images)], np.stack(image_metas), np.stack(windows)
+
+    def mold_layout(self, image_shape, max_dim=None):
+        """Computes how mold_inputs() resizes and pads an image of the given
+        shape, without molding it. Images can only be batched together if
+        they have the same molded_shape.
+
+        max_dim: Optional. See mold_inputs().
+
+        Returns:
+        scale: the scale factor of the resizing
+        (h, w): the size of the resized image, before padding
+        window: (y1, x1, y2, x2) of the resized image in the molded image
+        molded_shape: [height, width, channels] of the molded image
+        """
+        config = self.config
+        mode = config.IMAGE_RESIZE_MODE
+        min_dim, max_dim = self.resize_dims(max_dim)
+        h, w = image_shape[:2]
+        scale = utils.compute_resize_scale(
+            image_shape, min_dim=min_dim, max_dim=max_dim,
+            min_scale=config.IMAGE_MIN_SCALE, mode=mode)
+        if scale != 1:
+            h, w = round(h * scale), round(w * scale)
+        if mode == "none":
+            padding, window = [(0, 0), (0, 0), (0, 0)], (0, 0, h, w)
+        else:
+            padding, window = utils.compute_resize_padding(
+                (h, w), min_dim=min_dim, max_dim=max_dim, mode=mode)
+        molded_shape = (h + sum(padding[0]), w + sum(padding[1]), image_shape[2])
+        return scale, (h, w), window, molded_shape
+
+    def resize_dims(self, max_dim=None):
+        """Returns the (min_dim, max_dim) that images are resized with. These
+        are IMAGE_MIN_DIM and IMAGE_MAX_DIM, unless max_dim is given, in
+        which case it replaces IMAGE_MAX_DIM and caps IMAGE_MIN_DIM.
+
+        The inference graph takes images of any size, so it can be run at
+        another resolution than the one in the config, with the same weights.
+        """
+        if not max_dim:
+            return self.config.IMAGE_MIN_DIM, self.config.IMAGE_MAX_DIM
+        return min(self.config.IMAGE_MIN_DIM, max_dim), max_dim
+
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
-                          image_shape, window):
+                          image_shape, window, sparse_masks=False):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
@@ -2445,6 +2635,8 @@ class MaskRCNN():
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
                 image is excluding the padding.
+        sparse_masks: If True, masks are returned as utils.SparseMasks, which
+                only hold the mask of each instance within its box.
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
@@ -2487,6 +2679,10 @@ class MaskRCNN():
             masks = np.delete(masks, exclude_ix, axis=0)
             N = class_ids.shape[0]
 
+        if sparse_masks:
+            crops = [utils.unmold_mask_crop(masks[i], boxes[i]) for i in range(N)]
+            return boxes, class_ids, scores, utils.SparseMasks(boxes, crops, original_image_shape)
+
         # Resize masks to original image size and set boundary threshold.
         full_masks = []
         for i in range(N):
@@ -2498,10 +2694,49 @@ class MaskRCNN():
 
         return boxes, class_ids, scores, full_masks
 
-    def detect(self, images, verbose=0):
+    def pad_batch(self, *arrays):
+        """Pads batches of fewer than BATCH_SIZE items to BATCH_SIZE, by
+        repeating their last item. The inference graph is built for a fixed
+        batch size, so this lets a model serve any batch size up to it.
+
+        arrays: numpy arrays with the batch as their first dimension
+        Returns the padded arrays, in the same order.
+        """
+        padded = []
+        for a in arrays:
+            a = np.asarray(a)
+            missing = self.config.BATCH_SIZE - a.shape[0]
+            if missing > 0:
+                a = np.concatenate([a, np.repeat(a[-1:], missing, axis=0)], axis=0)
+            padded.append(a)
+        return padded
+
+    def run_inference(self, molded_images, image_metas, anchors):
+        """Runs the inference graph on a molded batch of 1 to BATCH_SIZE
+        images, padding it to BATCH_SIZE.
+
+        Returns the detections and mrcnn_mask outputs, which cover the
+        padding as well.
+        """
+        detections, _, _, mrcnn_mask, _, _, _ =\
+            self.keras_model.predict(self.pad_batch(molded_images, image_metas) + [anchors], verbose=0)
+        return detections, mrcnn_mask
+
+    def detect(self, images, verbose=0, timings=None, sparse_masks=False,
+               max_dim=None):
         """Runs the detection pipeline.
 
-        images: List of images, potentially of different sizes.
+        images: List of 1 to BATCH_SIZE images, potentially of different sizes.
+            Smaller batches are padded internally, and the results of the
+            padding are discarded.
+        timings: Optional. If a dict is given, the seconds spent molding the
+            inputs, running the model and unmolding the detections are added
+            to it under the "mold", "predict" and "unmold" keys.
+        sparse_masks: If True, masks are returned as utils.SparseMasks instead
+            of [H, W, N] arrays, so that their memory use scales with the area
+            of the objects rather than that of the image.
+        max_dim: Optional. Run at this resolution instead of IMAGE_MAX_DIM,
+            see resize_dims().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
@@ -2510,16 +2745,17 @@ class MaskRCNN():
         masks: [H, W, N] instance binary masks
         """
         assert self.mode == "inference", "Create model in inference mode."
-        assert len(
-            images) == self.config.BATCH_SIZE, "len(images) must be equal to BATCH_SIZE"
+        assert 0 < len(images) <= self.config.BATCH_SIZE,\
+            "len(images) must be between 1 and BATCH_SIZE"
 
         if verbose:
             log("Processing {} images".format(len(images)))
             for image in images:
                 log("image", image)
 
+        start = time.time()
         # Mold inputs to format expected by the neural network
-        molded_images, image_metas, windows = self.mold_inputs(images)
+        molded_images, image_metas, windows = self.mold_inputs(images, max_dim)
 
         # Validate image sizes
         # All images in a batch MUST be of the same size
@@ -2538,30 +2774,161 @@ class MaskRCNN():
             log("molded_images", molded_images)
             log("image_metas", image_metas)
             log("anchors", anchors)
-        # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        molded = time.time()
+        # Run object detection. Only the images themselves are molded and
+        # unmolded, the padding is added to the molded batch.
+        detections, mrcnn_mask = self.run_inference(molded_images, image_metas, anchors)
+        predicted = time.time()
         # Process detections
         results = []
         for i, image in enumerate(images):
             final_rois, final_class_ids, final_scores, final_masks =\
                 self.unmold_detections(detections[i], mrcnn_mask[i],
                                        image.shape, molded_images[i].shape,
-                                       windows[i])
+                                       windows[i], sparse_masks)
             results.append({
                 "rois": final_rois,
                 "class_ids": final_class_ids,
                 "scores": final_scores,
                 "masks": final_masks,
             })
+        if timings is not None:
+            for key, seconds in [("mold", molded - start), ("predict", predicted - molded),
+                                 ("unmold", time.time() - predicted)]:
+                timings[key] = timings.get(key, 0) + seconds
         return results
 
+    def detect_cascade(self, images, verbose=0, timings=None, sparse_masks=False):
+        """Runs the detection pipeline as a two-stage cascade.
+
+        All images are detected at CASCADE_MAX_DIM first, which is much
+        cheaper than at IMAGE_MAX_DIM, and only the images whose detections
+        call for it (see needs_full_resolution()) are detected again at
+        IMAGE_MAX_DIM. Images with few, large and confident detections thus
+        only take the cheap pass. Meant for the "square" resize mode, in
+        which IMAGE_MAX_DIM sets the resolution.
+
+        images, verbose, timings, sparse_masks: See detect().
+
+        Returns a list of dicts, one per image, as detect() does.
+        """
+        results = self.detect(images, verbose=verbose, timings=timings,
+                              sparse_masks=sparse_masks,
+                              max_dim=self.config.CASCADE_MAX_DIM)
+        escalated = [i for i, (image, r) in enumerate(zip(images, results))
+                     if self.needs_full_resolution(image, r)]
+        if verbose:
+            log("Detecting {} of {} images again at full resolution".format(
+                len(escalated), len(images)))
+        if escalated:
+            full = self.detect([images[i] for i in escalated], verbose=verbose,
+                               timings=timings, sparse_masks=sparse_masks)
+            for i, r in zip(escalated, full):
+                results[i] = r
+        return results
+
+    def needs_full_resolution(self, image, result):
+        """Decides whether an image that was detected at CASCADE_MAX_DIM
+        should be detected again at IMAGE_MAX_DIM. That is the case if it
+        has many detections (CASCADE_MAX_INSTANCES or more), several small
+        ones (CASCADE_MAX_SMALL_INSTANCES with a side of less than
+        CASCADE_SMALL_BOX_SIZE pixels at the low resolution), or uncertain
+        ones (scores within CASCADE_SCORE_MARGIN of DETECTION_MIN_CONFIDENCE),
+        which hint at objects that were missed.
+
+        image: the image, at its original size
+        result: its detections at CASCADE_MAX_DIM, as returned by detect()
+        """
+        config = self.config
+        count = len(result['class_ids'])
+        if count >= config.CASCADE_MAX_INSTANCES:
+            return True
+        if count and np.min(result['scores']) < \
+                config.DETECTION_MIN_CONFIDENCE + config.CASCADE_SCORE_MARGIN:
+            return True
+        min_dim, max_dim = self.resize_dims(config.CASCADE_MAX_DIM)
+        scale = utils.compute_resize_scale(
+            image.shape, min_dim=min_dim, max_dim=max_dim,
+            min_scale=config.IMAGE_MIN_SCALE, mode=config.IMAGE_RESIZE_MODE)
+        rois = result['rois']
+        sides = np.minimum(rois[:, 2] - rois[:, 0], rois[:, 3] - rois[:, 1]) * scale
+        return np.sum(sides < config.CASCADE_SMALL_BOX_SIZE) >= config.CASCADE_MAX_SMALL_INSTANCES
+
+    def detect_tiled(self, image, tile_size=None, overlap=0.25, threshold=0.5,
+                     verbose=0, timings=None, sparse_masks=False):
+        """Runs the detection pipeline on a large image, tile by tile.
+
+        The image is split into overlapping square tiles of tile_size, which
+        are detected BATCH_SIZE at a time. Small objects are thus detected at
+        (up to) full resolution, instead of being shrunk along with the whole
+        image, and the memory used by the model depends on the tile size only.
+        Detections are mapped back to image coordinates and merged across the
+        overlaps with a mask NMS (see utils.merge_tile_detections).
+
+        image: [height, width, 3] image of any size
+        tile_size: the side of the tiles. Defaults to IMAGE_MAX_DIM, so that
+            tiles are not resized in "square" mode.
+        overlap: the fraction of the tile size that neighbouring tiles share.
+            Objects smaller than the overlap are complete in at least one tile.
+        threshold: detections that share more than this fraction of the
+            smaller mask are merged.
+        timings, sparse_masks: Optional. See detect().
+
+        Returns a dict with rois, class_ids, scores and masks, as detect()
+        does for a single image.
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        tile_size = tile_size or self.config.IMAGE_MAX_DIM
+        height, width = image.shape[:2]
+        # All tiles have the same size, so that they can be batched
+        tile_h, tile_w = min(tile_size, height), min(tile_size, width)
+        ys = utils.compute_tile_starts(height, tile_h, int(tile_h * overlap))
+        xs = utils.compute_tile_starts(width, tile_w, int(tile_w * overlap))
+        tiles = [(y, x) for y in ys for x in xs]
+        if verbose:
+            log("Processing {} tiles of {}x{}".format(len(tiles), tile_h, tile_w))
+
+        # Detections touching a tile edge within this margin may be cut off
+        margin = 2
+        boxes, class_ids, scores, masks, truncated = [], [], [], [], []
+        batch_size = self.config.BATCH_SIZE
+        for i in range(0, len(tiles), batch_size):
+            batch = tiles[i:i + batch_size]
+            crops = [image[y:y + tile_h, x:x + tile_w] for y, x in batch]
+            results = self.detect(crops, verbose=verbose, timings=timings,
+                                  sparse_masks=True)
+            for (y, x), r in zip(batch, results):
+                for j, (y1, x1, y2, x2) in enumerate(r['rois']):
+                    if y2 <= y1 or x2 <= x1:
+                        continue
+                    boxes.append([y1 + y, x1 + x, y2 + y, x2 + x])
+                    class_ids.append(r['class_ids'][j])
+                    scores.append(r['scores'][j])
+                    masks.append(r['masks'].crops[j])
+                    truncated.append((y > 0 and y1 <= margin) or
+                                     (x > 0 and x1 <= margin) or
+                                     (y + tile_h < height and y2 >= tile_h - margin) or
+                                     (x + tile_w < width and x2 >= tile_w - margin))
+
+        boxes = np.array(boxes, dtype=np.int32).reshape([-1, 4])
+        keep = utils.merge_tile_detections(boxes, np.array(scores), masks,
+                                           np.array(truncated, dtype=bool), threshold)
+
+        merged_masks = utils.SparseMasks(boxes[keep], [masks[i] for i in keep], image.shape)
+
+        return {
+            "rois": boxes[keep],
+            "class_ids": np.array(class_ids, dtype=np.int32)[keep],
+            "scores": np.array(scores, dtype=np.float32)[keep],
+            "masks": merged_masks if sparse_masks else merged_masks.to_dense(),
+        }
+
     def detect_molded(self, molded_images, image_metas, verbose=0):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
         the model.
 
-        molded_images: List of images loaded using load_image_gt()
+        molded_images: List of 1 to BATCH_SIZE images loaded using load_image_gt()
         image_metas: image meta data, also returned by load_image_gt()
 
         Returns a list of dicts, one dict per image. The dict contains:
@@ -2571,8 +2938,8 @@ class MaskRCNN():
         masks: [H, W, N] instance binary masks
         """
         assert self.mode == "inference", "Create model in inference mode."
-        assert len(molded_images) == self.config.BATCH_SIZE,\
-            "Number of images must be equal to BATCH_SIZE"
+        assert 0 < len(molded_images) <= self.config.BATCH_SIZE,\
+            "Number of images must be between 1 and BATCH_SIZE"
 
         if verbose:
             log("Processing {} images".format(len(molded_images)))
@@ -2596,8 +2963,7 @@ class MaskRCNN():
             log("image_metas", image_metas)
             log("anchors", anchors)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        detections, mrcnn_mask = self.run_inference(molded_images, image_metas, anchors)
         # Process detections
         results = []
         for i, image in enumerate(molded_images):
@@ -2617,10 +2983,13 @@ class MaskRCNN():
     def get_anchors(self, image_shape):
         """Returns anchor pyramid for the given image size."""
         backbone_shapes = compute_backbone_shapes(self.config, image_shape)
-        # Cache anchors and reuse if image shape is the same
+        # Cache anchors and reuse if image shape is the same. The anchors of
+        # the least recently used shapes are evicted above ANCHOR_CACHE_SIZE.
         if not hasattr(self, "_anchor_cache"):
-            self._anchor_cache = {}
-        if not tuple(image_shape) in self._anchor_cache:
+            self._anchor_cache = OrderedDict()
+        if tuple(image_shape) in self._anchor_cache:
+            self._anchor_cache.move_to_end(tuple(image_shape))
+        else:
             # Generate Anchors
             a = utils.generate_pyramid_anchors(
                 self.config.RPN_ANCHOR_SCALES,
@@ -2634,6 +3003,8 @@ class MaskRCNN():
             self.anchors = a
             # Normalize coordinates
             self._anchor_cache[tuple(image_shape)] = utils.norm_boxes(a, image_shape[:2])
+            while len(self._anchor_cache) > self.config.ANCHOR_CACHE_SIZE:
+                self._anchor_cache.popitem(last=False)
         return self._anchor_cache[tuple(image_shape)]
 
     def ancestor(self, tensor, name, checked=None):
@@ -2736,6 +3107,88 @@ class MaskRCNN():
             log(k, v)
         return outputs_np
 
+    def export_frozen_graph(self, filepath):
+        """Writes the inference graph, with the current weights folded into
+        it as constants, to a single file that FrozenMaskRCNN can run
+        without building the Keras model or loading the weights again.
+
+        The graph is specific to the config, BATCH_SIZE included, so it
+        must be run with the same config that it was exported with.
+
+        filepath: path of the serialized GraphDef (usually .pb) to write
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        session = K.get_session()
+        graph = session.graph
+        with graph.as_default():
+            # Name the outputs, so that they can be found in the frozen graph
+            outputs = [(FROZEN_DETECTIONS, lambda: self.keras_model.outputs[0]),
+                       (FROZEN_MASKS, lambda: self.keras_model.outputs[3]),
+                       (FROZEN_BATCH_SIZE, lambda: tf.constant(self.config.BATCH_SIZE))]
+            for name, tensor in outputs:
+                try:
+                    graph.get_operation_by_name(name)
+                except KeyError:
+                    tf.identity(tensor(), name=name)
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session, graph.as_graph_def(), [name for name, _ in outputs])
+        with open(filepath, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        log("Exported the frozen graph ({} nodes) to {}".format(
+            len(graph_def.node), filepath))
+
+
+############################################################
+#  Frozen Inference Graph
+############################################################
+
+# Names of the outputs of the graphs written by MaskRCNN.export_frozen_graph()
+FROZEN_DETECTIONS = "frozen_detections"
+FROZEN_MASKS = "frozen_mrcnn_mask"
+FROZEN_BATCH_SIZE = "frozen_batch_size"
+
+
+class FrozenMaskRCNN(MaskRCNN):
+    """Runs an inference graph written by MaskRCNN.export_frozen_graph().
+
+    Molding, anchors and unmolding are inherited from MaskRCNN, so detect(),
+    detect_tiled() and detect_molded() behave the same. But the Keras model
+    is never built and there are no weights to load, so it is ready in the
+    time it takes to read the graph.
+    """
+
+    def __init__(self, config, filepath):
+        """
+        config: The config that the graph was exported with. Its threading
+            profile is applied to the session that runs the graph.
+        filepath: Path of the frozen graph
+        """
+        self.mode = "inference"
+        self.config = config
+        self.keras_model = None
+
+        graph_def = tf.GraphDef()
+        with open(filepath, "rb") as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph, config=apply_threading_profile(config))
+
+        tensor = self.graph.get_tensor_by_name
+        self.inputs = [tensor("input_image:0"), tensor("input_image_meta:0"),
+                       tensor("input_anchors:0")]
+        self.outputs = [tensor(FROZEN_DETECTIONS + ":0"), tensor(FROZEN_MASKS + ":0")]
+        batch_size = self.session.run(tensor(FROZEN_BATCH_SIZE + ":0"))
+        if batch_size != config.BATCH_SIZE:
+            raise ValueError("The graph was exported with a BATCH_SIZE of {}, "
+                             "but the config has {}".format(batch_size, config.BATCH_SIZE))
+
+    def run_inference(self, molded_images, image_metas, anchors):
+        """See MaskRCNN.run_inference()"""
+        feed_dict = dict(zip(self.inputs, self.pad_batch(molded_images, image_metas) + [anchors]))
+        return self.session.run(self.outputs, feed_dict=feed_dict)
+
 
 ############################################################
 #  Data Formatting
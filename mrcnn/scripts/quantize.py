@@ -0,0 +1,194 @@
+"""
+Post-training weight quantization of the Clomask model for CPU inference.
+
+Writes a weight store (see utils.convert_h5_weights) with the kernels of the
+model quantized to int8, with a scale per output channel, or to float16.
+Calibration runs a sample of the synthetic training images through the
+float32 model, and through the model with one group of layers quantized at a
+time. Only the groups whose detections stay within --tolerance of the
+float32 ones are quantized. Finally, the mAP on the test images, the latency
+and the size of the weights are reported for both models.
+
+Quantized kernels are converted back to float32 when they are loaded, as
+TensorFlow has no reduced precision kernels for the model on CPU. The store
+is 4 (int8) or 2 (float16) times smaller, so it loads faster.
+
+    python quantize.py --weights ../mask_data/logs/mask_rcnn_clomask_0055.h5 --output ../mask_data/clomask_int8
+"""
+
+from config import *
+from train import ClomaskDataset
+import re
+import random
+import tempfile
+import time
+import numpy as np
+from argparse import ArgumentParser
+
+
+class QuantizationConfig(ClomaskConfig):
+    """
+    Inference configuration of the model server, one image at a time.
+    """
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    IMAGE_RESIZE_MODE = "square"
+    IMAGE_MIN_DIM = 1024
+    IMAGE_MAX_DIM = 1024
+    POST_NMS_ROIS_INFERENCE = 2000
+    FAST_MOLDING = True
+
+
+# Layers that are calibrated together, by a regex of their names
+LAYER_GROUPS = [
+    ("stage1", r"(conv1|bn_conv1)$"),
+    ("stage2", r"(res|bn)2"),
+    ("stage3", r"(res|bn)3"),
+    ("stage4", r"(res|bn)4"),
+    ("stage5", r"(res|bn)5"),
+    ("fpn", r"fpn_"),
+    ("rpn", r"rpn_model$"),
+    ("heads", r"mrcnn_"),
+]
+
+
+def store_size(store_path):
+    """
+        Size of a weight store on disk, in MB.
+    """
+    return sum(os.path.getsize(os.path.join(store_path, f)) for f in os.listdir(store_path)) / 2**20
+
+
+def fidelity(model, images, references):
+    """
+        Mean AP of the detections of the model, with the float32 detections as the ground truth.
+    """
+    aps = []
+    for image, ref in zip(images, references):
+        if not len(ref['class_ids']):
+            continue
+        r = model.detect([image])[0]
+        ap, _, _, _ = utils.compute_ap(ref['rois'], ref['class_ids'], ref['masks'],
+                                       r['rois'], r['class_ids'], r['scores'], r['masks'])
+        aps.append(ap)
+    return np.mean(aps)
+
+
+def evaluate(model, dataset, config, image_ids):
+    """
+        mAP @ IoU=0.5 and the median and 99th percentile latency (ms) of the model on a dataset.
+    """
+    aps, latencies = [], []
+    for image_id in image_ids:
+        image, _, gt_class_ids, gt_boxes, gt_masks = modellib.load_image_gt(dataset, config, image_id)
+        start = time.time()
+        r = model.detect([image])[0]
+        latencies.append((time.time() - start) * 1000)
+        ap, _, _, _ = utils.compute_ap(gt_boxes, gt_class_ids, gt_masks,
+                                       r['rois'], r['class_ids'], r['scores'], r['masks'])
+        aps.append(ap)
+    return np.mean(aps), np.median(latencies), np.percentile(latencies, 99)
+
+
+def load_dataset(path, limit, seed):
+    """
+        A random sample of up to limit images of a dataset directory.
+    """
+    ids = sorted(os.listdir(path))
+    random.Random(seed).shuffle(ids)
+    dataset = ClomaskDataset()
+    dataset.load_shapes(ids[:limit], path)
+    dataset.prepare()
+    return dataset
+
+
+def calibrate(model, float_weights, quantized_weights, images, tolerance):
+    """
+        Quantize each group of layers on its own, and return the names of the layers of the
+        groups that keep the fidelity of the detections above 1 - tolerance.
+    """
+    references = [model.detect([image])[0] for image in images]
+    if not any(len(ref['class_ids']) for ref in references):
+        # There would be nothing to measure the fidelity against
+        raise ValueError("The float32 model detects nothing in the {} calibration images, "
+                         "calibrate on more of them".format(len(images)))
+
+    layers = []
+    for group, pattern in LAYER_GROUPS:
+        group_layers = [name for name in float_weights if re.match(pattern, name)]
+        model.set_weights_by_name({name: quantized_weights[name] for name in group_layers})
+        score = fidelity(model, images, references)
+        model.set_weights_by_name(float_weights)
+        keep = score >= 1 - tolerance
+        print('{:10} {:4} layers  fidelity {:.4f}  {}'.format(
+            group, len(group_layers), score, 'quantized' if keep else 'kept at float32'))
+        if keep:
+            layers += group_layers
+
+    model.set_weights_by_name({name: quantized_weights[name] for name in layers})
+    print('All quantized groups: fidelity {:.4f}'.format(fidelity(model, images, references)))
+    return layers
+
+
+def parse_args():
+    """Parse arguments from the command line"""
+    parser = ArgumentParser(description="Quantize the weights of the model for CPU inference")
+    parser.add_argument("--weights", required=True, help="The float32 weights, h5 or a weight store")
+    parser.add_argument("--output", required=True, help="The directory to write the quantized weight store to")
+    parser.add_argument("--dtype", required=False, choices=["int8", "float16"], default="int8", help="The precision of the quantized kernels")
+    parser.add_argument("--calibration-images", required=False, type=int, default=20, help="The number of training images to calibrate on")
+    parser.add_argument("--eval-images", required=False, type=int, default=100, help="The number of test images to report the mAP on")
+    parser.add_argument("--tolerance", required=False, type=float, default=0.02, help="The largest drop in fidelity to the float32 detections that a group of layers may cause")
+    parser.add_argument("--seed", required=False, type=int, default=2019, help="Seed of the image samples")
+
+    return parser.parse_args()
+
+
+def quantize(args, float_store):
+    """
+        Calibrate, quantize and evaluate the float32 weights in a weight store.
+    """
+    config = QuantizationConfig()
+
+    model = modellib.MaskRCNN(mode="inference", config=config, model_dir=MODEL_DIR)
+    model.load_weights(float_store)
+
+    float_weights = {name: [value for _, value in weights]
+                     for name, weights in utils.load_weight_store(float_store).items()}
+    quantized_weights = {name: [utils.dequantize_weights(*utils.quantize_weights(value, args.dtype))
+                                if value.ndim >= 2 else value for value in values]
+                         for name, values in float_weights.items()}
+
+    calibration_data = load_dataset(TRAIN_PATH, args.calibration_images, args.seed)
+    images = [calibration_data.load_image(image_id, config.IMAGE_COLOR) for image_id in calibration_data.image_ids]
+    layers = calibrate(model, float_weights, quantized_weights, images, args.tolerance)
+    utils.quantize_weight_store(float_store, args.output, args.dtype, layers)
+
+    eval_data = load_dataset(TEST_PATH, args.eval_images, args.seed)
+    # The first detection is much slower, keep it out of the latencies
+    model.detect(images[:1])
+    report = []
+    for name, store in [('float32', float_store), (args.dtype, args.output)]:
+        model.load_weights(store)
+        report.append((name, store_size(store)) + evaluate(model, eval_data, config, eval_data.image_ids))
+
+    print('\n{:10} {:>10} {:>8} {:>12} {:>12}'.format('weights', 'size (MB)', 'mAP', 'p50 (ms)', 'p99 (ms)'))
+    for row in report:
+        print('{:10} {:>10.1f} {:>8.4f} {:>12.1f} {:>12.1f}'.format(*row))
+
+
+def main(args):
+    if utils.is_weight_store(args.weights):
+        quantize(args, args.weights)
+        return
+
+    # Quantize a weight store converted from the h5 weights, which is removed when done
+    with tempfile.TemporaryDirectory() as float_store:
+        utils.convert_h5_weights(args.weights, float_store)
+        quantize(args, float_store)
+
+
+if __name__ == '__main__':
+    start = time.time()
+    main(parse_args())
+    print('Elapsed time', round((time.time() - start)/60, 1), 'minutes')
@@ -8,6 +8,7 @@ Written by Waleed Abdulla
 
 import sys
 import os
+import json
 import math
 import random
 import numpy as np
@@ -19,6 +20,7 @@ import skimage.transform
 import urllib.request
 import shutil
 import warnings
+from collections import OrderedDict
 from distutils.version import LooseVersion
 
 # URL from which to download the latest COCO trained weights
@@ -94,9 +96,12 @@ def compute_overlaps(boxes1, boxes2):
 
 def compute_overlaps_masks(masks1, masks2):
     """Computes IoU overlaps between two sets of masks.
-    masks1, masks2: [Height, Width, instances]
+    masks1, masks2: [Height, Width, instances], or lists of RLEs (see
+        rle_encode), in which case the IoUs are computed on the RLEs.
     """
-    
+    if isinstance(masks1, list) and isinstance(masks2, list):
+        return compute_overlaps_rle(masks1, masks2)
+
     # If either set of masks is empty return empty result
     if masks1.shape[-1] == 0 or masks2.shape[-1] == 0:
         return np.zeros((masks1.shape[-1], masks2.shape[-1]))
@@ -151,6 +156,79 @@ def non_max_suppression(boxes, scores, threshold):
     return np.array(pick, dtype=np.int32)
 
 
+############################################################
+#  Tiling
+############################################################
+
+def compute_tile_starts(length, tile_size, overlap):
+    """Computes the start offsets of tiles that cover [0, length).
+    length: the size of the image along one axis
+    tile_size: the size of the tiles along the same axis
+    overlap: the minimum number of pixels that neighbouring tiles share
+
+    The tiles are spread evenly, and the last one ends at length, so that all
+    tiles have the same size. Returns a list of offsets.
+    """
+    if length <= tile_size:
+        return [0]
+    stride = max(1, tile_size - overlap)
+    count = int(math.ceil((length - tile_size) / stride)) + 1
+    return np.round(np.linspace(0, length - tile_size, count)).astype(int).tolist()
+
+
+def crop_masks_intersection(box1, mask1, box2, mask2):
+    """Computes the number of pixels shared by two masks that are cropped to their boxes.
+    box1, box2: (y1, x1, y2, x2) in image coordinates
+    mask1, mask2: [y2 - y1, x2 - x1] binary masks
+    """
+    y1 = max(box1[0], box2[0])
+    x1 = max(box1[1], box2[1])
+    y2 = min(box1[2], box2[2])
+    x2 = min(box1[3], box2[3])
+    if y2 <= y1 or x2 <= x1:
+        return 0
+    m1 = mask1[y1 - box1[0]:y2 - box1[0], x1 - box1[1]:x2 - box1[1]]
+    m2 = mask2[y1 - box2[0]:y2 - box2[0], x1 - box2[1]:x2 - box2[1]]
+    return np.count_nonzero(np.logical_and(m1, m2))
+
+
+def merge_tile_detections(boxes, scores, masks, truncated, threshold):
+    """Merges the detections of the same objects in overlapping tiles, i.e.
+    a mask NMS, and returns the indices of the detections to keep.
+    boxes: [N, (y1, x1, y2, x2)] in image coordinates
+    scores: [N] float scores
+    masks: list of N binary masks, each cropped to its box
+    truncated: [N] bool. Whether each detection touches an edge of its tile
+        that is inside the image, i.e. whether the tile may have cut it off.
+    threshold: Float. Detections that share more than this fraction of the
+        smaller mask are considered to be the same object.
+
+    Complete detections are kept over truncated ones, and then higher scores
+    over lower ones. The fraction of the smaller mask is used rather than the
+    IoU, since a truncated detection is only a part of the complete one.
+    """
+    if not len(boxes):
+        return np.zeros([0], dtype=np.int32)
+    areas = np.array([np.count_nonzero(m) for m in masks])
+    # Only the masks of detections whose boxes overlap need to be compared
+    box_overlaps = compute_overlaps(boxes.astype(np.float32), boxes.astype(np.float32)) > 0
+
+    order = np.lexsort((-np.asarray(scores), np.asarray(truncated)))
+    keep = []
+    for i in order:
+        if areas[i] == 0:
+            continue
+        for j in keep:
+            if not box_overlaps[i, j]:
+                continue
+            intersection = crop_masks_intersection(boxes[i], masks[i], boxes[j], masks[j])
+            if intersection > threshold * min(areas[i], areas[j]):
+                break
+        else:
+            keep.append(i)
+    return np.array(keep, dtype=np.int32)
+
+
 def apply_box_deltas(boxes, deltas):
     """Applies the given deltas to the given boxes.
     boxes: [N, (y1, x1, y2, x2)]. Note that (y2, x2) is outside the box.
@@ -386,7 +464,8 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
             of size [max_dim, max_dim].
         pad64: Pads width and height with zeros to make them multiples of 64.
                If min_dim or min_scale are provided, it scales the image up
-               before padding. max_dim is ignored in this mode.
+               before padding. If max_dim is provided, it then scales the
+               image down, if needed, so that its longest side fits in it.
                The multiple of 64 is needed to ensure smooth scaling of feature
                maps up and down the 6 levels of the FPN pyramid (2**6=64).
         crop: Picks random crops from the image. First, scales the image based
@@ -414,6 +493,39 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     if mode == "none":
         return image, window, scale, padding, crop
 
+    scale = compute_resize_scale(image.shape, min_dim, max_dim, min_scale, mode)
+
+    # Resize image using bilinear interpolation
+    if scale != 1:
+        image = resize(image, (round(h * scale), round(w * scale)),
+                       preserve_range=True)
+
+    # Need padding or cropping?
+    if mode in ["square", "pad64"]:
+        padding, window = compute_resize_padding(image.shape, min_dim, max_dim, mode)
+        image = np.pad(image, padding, mode='constant', constant_values=0)
+    elif mode == "crop":
+        # Pick a random crop
+        h, w = image.shape[:2]
+        y = random.randint(0, (h - min_dim))
+        x = random.randint(0, (w - min_dim))
+        crop = (y, x, min_dim, min_dim)
+        image = image[y:y + min_dim, x:x + min_dim]
+        window = (0, 0, min_dim, min_dim)
+    else:
+        raise Exception("Mode {} not supported".format(mode))
+    return image.astype(image_dtype), window, scale, padding, crop
+
+
+def compute_resize_scale(image_shape, min_dim=None, max_dim=None, min_scale=None, mode="square"):
+    """Computes the scale factor that resize_image() applies to an image of
+    image_shape. See resize_image() for the arguments.
+    """
+    h, w = image_shape[:2]
+    scale = 1
+    if mode == "none":
+        return scale
+
     # Scale?
     if min_dim:
         # Scale up but not down
@@ -422,29 +534,28 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
         scale = min_scale
 
     # Does it exceed max dim?
-    if max_dim and mode == "square":
+    if max_dim and mode in ["square", "pad64"]:
         image_max = max(h, w)
         if round(image_max * scale) > max_dim:
             scale = max_dim / image_max
+    return scale
 
-    # Resize image using bilinear interpolation
-    if scale != 1:
-        image = resize(image, (round(h * scale), round(w * scale)),
-                       preserve_range=True)
 
-    # Need padding or cropping?
+def compute_resize_padding(image_shape, min_dim=None, max_dim=None, mode="square"):
+    """Computes the padding that resize_image() adds to an image after it has
+    been resized to image_shape, in the "square" and "pad64" modes.
+
+    Returns:
+    padding: [(top, bottom), (left, right), (0, 0)]
+    window: (y1, x1, y2, x2) of the image within the padded image
+    """
+    h, w = image_shape[:2]
     if mode == "square":
-        # Get new height and width
-        h, w = image.shape[:2]
         top_pad = (max_dim - h) // 2
         bottom_pad = max_dim - h - top_pad
         left_pad = (max_dim - w) // 2
         right_pad = max_dim - w - left_pad
-        padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
-        image = np.pad(image, padding, mode='constant', constant_values=0)
-        window = (top_pad, left_pad, h + top_pad, w + left_pad)
     elif mode == "pad64":
-        h, w = image.shape[:2]
         # Both sides must be divisible by 64
         assert min_dim % 64 == 0, "Minimum dimension must be a multiple of 64"
         # Height
@@ -461,20 +572,11 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
             right_pad = max_w - w - left_pad
         else:
             left_pad = right_pad = 0
-        padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
-        image = np.pad(image, padding, mode='constant', constant_values=0)
-        window = (top_pad, left_pad, h + top_pad, w + left_pad)
-    elif mode == "crop":
-        # Pick a random crop
-        h, w = image.shape[:2]
-        y = random.randint(0, (h - min_dim))
-        x = random.randint(0, (w - min_dim))
-        crop = (y, x, min_dim, min_dim)
-        image = image[y:y + min_dim, x:x + min_dim]
-        window = (0, 0, min_dim, min_dim)
     else:
-        raise Exception("Mode {} not supported".format(mode))
-    return image.astype(image_dtype), window, scale, padding, crop
+        raise Exception("Mode {} does not pad".format(mode))
+    padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
+    window = (top_pad, left_pad, h + top_pad, w + left_pad)
+    return padding, window
 
 
 def resize_mask(mask, scale, padding, crop=None):
@@ -546,10 +648,8 @@ def unmold_mask(mask, bbox, image_shape):
     bbox: [y1, x1, y2, x2]. The box to fit the mask in.
     Returns a binary mask with the same size as the original image.
     """
-    threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = resize(mask, (y2 - y1, x2 - x1))
-    mask = np.where(mask >= threshold, 1, 0).astype(np.bool)
+    mask = unmold_mask_crop(mask, bbox)
 
     # Put the mask in the right location.
     full_mask = np.zeros(image_shape[:2], dtype=np.bool)
@@ -557,6 +657,295 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def unmold_mask_crop(mask, bbox):
+    """Like unmold_mask(), but returns the binary mask of the box only,
+    i.e. [y2 - y1, x2 - x1], instead of pasting it into a full size mask.
+    """
+    threshold = 0.5
+    y1, x1, y2, x2 = bbox
+    mask = resize(mask, (y2 - y1, x2 - x1))
+    return np.where(mask >= threshold, 1, 0).astype(np.bool)
+
+
+class SparseMasks(object):
+    """Instance masks stored as crops of their bounding boxes.
+
+    Stands in for the [height, width, N] masks returned by detect(), but
+    takes memory in proportion to the area of the objects rather than that
+    of the image times N. Indexing with [..., i] or [y1:y2, x1:x2, i]
+    densifies only the requested window of instance i.
+
+    boxes: [N, (y1, x1, y2, x2)] in pixels
+    crops: list of N binary masks, each [y2 - y1, x2 - x1]
+    image_shape: [height, width, ...] of the image
+    """
+    dtype = np.dtype(bool)
+
+    def __init__(self, boxes, crops, image_shape):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape([-1, 4])
+        self.crops = list(crops)
+        self.image_shape = tuple(int(d) for d in image_shape[:2])
+        assert len(self.boxes) == len(self.crops)
+
+    @property
+    def shape(self):
+        return self.image_shape + (len(self.crops),)
+
+    def densify(self, i, window=None):
+        """Returns the mask of instance i as a binary array of the given window
+        (y1, x1, y2, x2), or of the whole image if window is None.
+        """
+        if window is None:
+            window = (0, 0) + self.image_shape
+        wy1, wx1, wy2, wx2 = window
+        dense = np.zeros([wy2 - wy1, wx2 - wx1], dtype=bool)
+        y1, x1, y2, x2 = self.boxes[i]
+        iy1, ix1 = max(y1, wy1), max(x1, wx1)
+        iy2, ix2 = min(y2, wy2), min(x2, wx2)
+        if iy2 > iy1 and ix2 > ix1:
+            dense[iy1 - wy1:iy2 - wy1, ix1 - wx1:ix2 - wx1] = \
+                self.crops[i][iy1 - y1:iy2 - y1, ix1 - x1:ix2 - x1]
+        return dense
+
+    def to_dense(self):
+        """Returns the [height, width, N] binary masks"""
+        masks = np.zeros(self.shape, dtype=bool)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            masks[y1:y2, x1:x2, i] = self.crops[i]
+        return masks
+
+    def __array__(self, dtype=None):
+        masks = self.to_dense()
+        return masks if dtype is None else masks.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple) or not isinstance(key[-1], (int, np.integer)):
+            raise IndexError("SparseMasks can only be indexed with [..., i] or [rows, cols, i]")
+        if key[0] is Ellipsis and len(key) == 2:
+            rows, cols = slice(None), slice(None)
+        elif len(key) == 3:
+            rows, cols = key[0], key[1]
+        else:
+            raise IndexError("SparseMasks can only be indexed with [..., i] or [rows, cols, i]")
+
+        wy1, wy2, y_step = rows.indices(self.image_shape[0])
+        wx1, wx2, x_step = cols.indices(self.image_shape[1])
+        assert y_step == 1 and x_step == 1, "Slices with steps are not supported"
+        return self.densify(key[-1], (wy1, wx1, max(wy1, wy2), max(wx1, wx2)))
+
+    def select(self, indices):
+        """Returns the masks of a subset of the instances, given by integer
+        indices or by a boolean array.
+        """
+        indices = np.arange(len(self.crops))[indices]
+        return SparseMasks(self.boxes[indices], [self.crops[i] for i in indices], self.image_shape)
+
+    def rescale(self, shape):
+        """Returns the masks resized to an image of (height, width) shape, with
+        nearest neighbour interpolation. Pixel (y, x) of the result is pixel
+        (y * height // new height, x * width // new width) of the original.
+        """
+        height, width = self.image_shape
+        new_height, new_width = shape[:2]
+        boxes, crops = [], []
+        for (y1, x1, y2, x2), crop in zip(self.boxes, self.crops):
+            # The range of new pixels that map into the box, i.e. ceil(y1 * new_height / height)...
+            ny1, ny2 = -(-y1 * new_height // height), -(-y2 * new_height // height)
+            nx1, nx2 = -(-x1 * new_width // width), -(-x2 * new_width // width)
+            rows = np.arange(ny1, ny2) * height // new_height - y1
+            cols = np.arange(nx1, nx2) * width // new_width - x1
+            boxes.append([ny1, nx1, ny2, nx2])
+            crops.append(crop[rows[:, None], cols])
+        return SparseMasks(boxes, crops, (new_height, new_width))
+
+
+############################################################
+#  RLE masks
+############################################################
+
+# Masks are run-length encoded as in the COCO API: {"size": [height, width],
+# "counts": [...]}, where counts alternate between runs of 0s and 1s, starting
+# with 0s, over the pixels in column-major (Fortran) order. counts may also be
+# the compressed string that pycocotools produces.
+
+def rle_encode(mask):
+    """Encodes a [height, width] binary mask as an RLE."""
+    pixels = np.asarray(mask, dtype=bool).ravel(order="F")
+    boundaries = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], boundaries, [pixels.size]]))
+    if pixels.size and pixels[0]:
+        counts = np.concatenate([[0], counts])
+    return {"size": [int(d) for d in mask.shape[:2]], "counts": counts.tolist()}
+
+
+def rle_encode_crop(crop, box, image_shape):
+    """Encodes the mask of a box as an RLE of the whole image, without
+    pasting it into a full size mask.
+
+    crop: [y2 - y1, x2 - x1] binary mask of the box
+    box: (y1, x1, y2, x2) of the crop in the image
+    image_shape: [height, width, ...] of the image
+    """
+    height, width = image_shape[:2]
+    y1, x1 = int(box[0]), int(box[1])
+    # Pad each column of the crop with 0s, so that runs of 1s start and end
+    # within their column
+    padded = np.zeros([crop.shape[0] + 2, crop.shape[1]], dtype=bool)
+    padded[1:-1] = crop
+    changes = np.flatnonzero(np.diff(padded.ravel(order="F"))) + 1
+    cols, rows = np.divmod(changes, padded.shape[0])
+    boundaries = (x1 + cols) * height + y1 + rows - 1
+    # A run that ends at the bottom of a column and one that starts at the top
+    # of the next are a single run in the image
+    joined = np.flatnonzero(boundaries[1:-1:2] == boundaries[2::2]) * 2 + 1
+    boundaries = np.delete(boundaries, np.concatenate([joined, joined + 1]))
+    counts = np.diff(np.concatenate([[0], boundaries, [height * width]]))
+    if len(boundaries) and boundaries[-1] == height * width:
+        counts = counts[:-1]
+    return {"size": [int(height), int(width)], "counts": counts.tolist()}
+
+
+def rle_decode(rle):
+    """Decodes an RLE into a [height, width] binary mask."""
+    height, width = rle["size"]
+    counts = _rle_counts(rle)
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape([width, height]).T
+
+
+def rle_to_string(rle):
+    """Compresses the counts of an RLE into the string format of pycocotools."""
+    counts = _rle_counts(rle)
+    chars = []
+    for i, x in enumerate(counts.tolist()):
+        # Counts after the first two are stored as differences
+        if i > 2:
+            x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return {"size": list(rle["size"]), "counts": "".join(chars)}
+
+
+def _rle_counts(rle):
+    """Returns the counts of an RLE as an int64 array, decompressing them if needed."""
+    counts = rle["counts"]
+    if not isinstance(counts, (str, bytes)):
+        return np.asarray(counts, dtype=np.int64)
+
+    if isinstance(counts, bytes):
+        counts = counts.decode("ascii")
+    values = []
+    p = 0
+    while p < len(counts):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(counts[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << (5 * k)
+        if len(values) > 2:
+            x += values[-2]
+        values.append(x)
+    return np.array(values, dtype=np.int64)
+
+
+def _rle_runs(rle):
+    """Returns the [start, end) pixel offsets of the runs of 1s of an RLE."""
+    boundaries = np.cumsum(np.concatenate([[0], _rle_counts(rle)]))
+    ends = boundaries[2::2]
+    return boundaries[1:1 + len(ends) * 2:2], ends
+
+
+def _runs_to_rle(starts, ends, size):
+    """Builds an RLE from sorted, non-overlapping runs of 1s."""
+    boundaries = np.stack([starts, ends], axis=1).ravel()
+    counts = np.diff(np.concatenate([[0], boundaries, [size[0] * size[1]]]))
+    return {"size": list(size), "counts": counts.tolist()}
+
+
+def rle_area(rle):
+    """Returns the number of pixels of an RLE that are 1."""
+    return int(np.sum(_rle_counts(rle)[1::2]))
+
+
+def rle_to_bbox(rle):
+    """Returns the bounding box (y1, x1, y2, x2) of an RLE, as extract_bboxes
+    does for masks, i.e. (y2, x2) lays outside the box. Empty masks get
+    (0, 0, 0, 0).
+    """
+    height = rle["size"][0]
+    starts, ends = _rle_runs(rle)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep] - 1
+    if not len(starts):
+        return np.zeros([4], dtype=np.int32)
+    first_cols, last_cols = starts // height, ends // height
+    # Runs that span several columns cover the whole height
+    spans = first_cols != last_cols
+    y1 = np.where(spans, 0, starts % height).min()
+    y2 = np.where(spans, height - 1, ends % height).max()
+    return np.array([y1, first_cols.min(), y2 + 1, last_cols.max() + 1], dtype=np.int32)
+
+
+def rle_merge(rles, intersect=False):
+    """Merges RLEs of the same size into the RLE of their union, or of their
+    intersection if intersect is True.
+    """
+    assert rles, "At least one RLE is needed"
+    size = rles[0]["size"]
+    starts, ends = zip(*[_rle_runs(rle) for rle in rles])
+    starts, ends = np.concatenate(starts), np.concatenate(ends)
+
+    # Sweep over the run boundaries, counting how many runs cover each segment
+    positions = np.concatenate([starts, ends])
+    deltas = np.concatenate([np.ones_like(starts), -np.ones_like(ends)])
+    order = np.lexsort((deltas, positions))
+    positions, coverage = positions[order], np.cumsum(deltas[order])
+    inside = coverage >= (len(rles) if intersect else 1)
+    # Segments between consecutive boundaries where the coverage condition holds
+    segment_starts, segment_ends = positions[:-1][inside[:-1]], positions[1:][inside[:-1]]
+    keep = segment_ends > segment_starts
+    segment_starts, segment_ends = segment_starts[keep], segment_ends[keep]
+
+    # Join touching segments
+    if len(segment_starts):
+        joined = np.flatnonzero(segment_starts[1:] != segment_ends[:-1]) + 1
+        segment_starts = segment_starts[np.concatenate([[0], joined])]
+        segment_ends = segment_ends[np.concatenate([joined - 1, [len(segment_ends) - 1]])]
+    return _runs_to_rle(segment_starts, segment_ends, size)
+
+
+def compute_overlaps_rle(rles1, rles2):
+    """Computes IoU overlaps between two lists of RLEs of the same size,
+    without decoding them. Returns a [len(rles1), len(rles2)] matrix.
+    """
+    overlaps = np.zeros((len(rles1), len(rles2)))
+    if not rles1 or not rles2:
+        return overlaps
+    areas1 = np.array([rle_area(r) for r in rles1])
+    areas2 = np.array([rle_area(r) for r in rles2])
+    # Masks whose boxes don't overlap can't overlap either
+    boxes1 = np.array([rle_to_bbox(r) for r in rles1], dtype=np.float32)
+    boxes2 = np.array([rle_to_bbox(r) for r in rles2], dtype=np.float32)
+    candidates = np.argwhere(compute_overlaps(boxes1, boxes2) > 0)
+    for i, j in candidates:
+        intersection = rle_area(rle_merge([rles1[i], rles2[j]], intersect=True))
+        union = areas1[i] + areas2[j] - intersection
+        overlaps[i, j] = intersection / union if union else 0
+    return overlaps
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -619,6 +1008,167 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+############################################################
+#  Weight Store
+############################################################
+
+# The files of a weight store: the weights, one after the other, and an index
+# of where each weight is in that file
+WEIGHT_STORE_DATA = "weights.bin"
+WEIGHT_STORE_INDEX = "index.json"
+# Weights start on multiples of this, so that they can be viewed in place
+WEIGHT_STORE_ALIGNMENT = 64
+
+
+def convert_h5_weights(h5_path, store_path):
+    """Converts the weights in a Keras h5 file to a weight store.
+
+    A weight store is a directory with the raw weights in a single flat
+    file, and a small JSON index of the layer, name, dtype, shape and
+    offset of each. Loading it (see load_weight_store) memory-maps the file
+    instead of parsing it, so it is bound by the disk, and takes less time
+    and memory than loading the h5 file.
+
+    h5_path: weights saved by Keras, e.g. by MaskRCNN.train()
+    store_path: the directory to write the store to
+    """
+    import h5py
+    with h5py.File(h5_path, mode='r') as f:
+        g = f['model_weights'] if 'layer_names' not in f.attrs and 'model_weights' in f else f
+        layers = []
+        for layer_name in g.attrs['layer_names']:
+            layer_name = layer_name.decode('utf8') if isinstance(layer_name, bytes) else layer_name
+            weights = []
+            for weight_name in g[layer_name].attrs['weight_names']:
+                weight_name = weight_name.decode('utf8') if isinstance(weight_name, bytes) else weight_name
+                weights.append((weight_name, g[layer_name][weight_name][()], None))
+            layers.append((layer_name, weights))
+        write_weight_store(store_path, layers)
+
+
+def write_weight_store(store_path, layers):
+    """Writes a weight store, see convert_h5_weights().
+
+    layers: list of (layer name, weights), with the weights of each layer
+        a list of (weight name, value, scale). scale is None, or the scales
+        of a value quantized by quantize_weights().
+    """
+    os.makedirs(store_path, exist_ok=True)
+    index = []
+    with open(os.path.join(store_path, WEIGHT_STORE_DATA), "wb") as data:
+        def write(value):
+            value = np.ascontiguousarray(value)
+            data.write(b"\0" * (-data.tell() % WEIGHT_STORE_ALIGNMENT))
+            entry = {"dtype": value.dtype.str, "shape": value.shape, "offset": data.tell()}
+            data.write(value.tobytes())
+            return entry
+
+        for layer_name, weights in layers:
+            entries = []
+            for weight_name, value, scale in weights:
+                entry = dict(write(value), name=weight_name)
+                if scale is not None:
+                    entry["scale"] = write(scale)
+                entries.append(entry)
+            if entries:
+                index.append({"name": layer_name, "weights": entries})
+
+    with open(os.path.join(store_path, WEIGHT_STORE_INDEX), "w") as f:
+        json.dump({"layers": index}, f)
+
+
+def is_weight_store(path):
+    """True if path is a weight store written by convert_h5_weights()"""
+    return os.path.isfile(os.path.join(path, WEIGHT_STORE_INDEX))
+
+
+def load_weight_store(store_path, dequantize=True):
+    """Memory-maps a weight store written by convert_h5_weights().
+
+    dequantize: If True, quantized weights are converted back to float32.
+        Otherwise, their values are (value, scale) tuples, as returned by
+        quantize_weights().
+
+    Returns an OrderedDict of layer name to a list of (weight name, value)
+    in the order of the h5 file, which is that of the weights of the layer.
+    The values are read-only views into the store, and are only read from
+    disk as they are used. Dequantized values are in memory.
+    """
+    with open(os.path.join(store_path, WEIGHT_STORE_INDEX)) as f:
+        index = json.load(f)
+    data = np.memmap(os.path.join(store_path, WEIGHT_STORE_DATA), dtype=np.uint8, mode='r')
+
+    def read(entry):
+        dtype = np.dtype(entry["dtype"])
+        size = int(np.prod(entry["shape"])) * dtype.itemsize
+        return data[entry["offset"]:entry["offset"] + size].view(dtype).reshape(entry["shape"])
+
+    store = OrderedDict()
+    for layer in index["layers"]:
+        weights = []
+        for w in layer["weights"]:
+            value = read(w)
+            scale = read(w["scale"]) if "scale" in w else None
+            if scale is not None or value.dtype == np.float16:
+                value = dequantize_weights(value, scale) if dequantize else (value, scale)
+            weights.append((w["name"], value))
+        store[layer["name"]] = weights
+    return store
+
+
+def quantize_weights(value, dtype="int8"):
+    """Quantizes a float32 weight to a lower precision.
+
+    dtype: "float16", or "int8" for symmetric linear quantization, with one
+        scale per output channel (the last axis, as in Keras kernels).
+
+    Returns the quantized value, and the scales ([channels] float32), or
+    None for float16.
+    """
+    if dtype == "float16":
+        return value.astype(np.float16), None
+    assert dtype == "int8", "dtype must be int8 or float16"
+    axes = tuple(range(value.ndim - 1))
+    scale = np.abs(value).max(axis=axes) / 127.
+    # Channels that are all zeros are zeros whatever the scale
+    scale = np.where(scale > 0, scale, 1.).astype(np.float32)
+    quantized = np.clip(np.round(value / scale), -127, 127).astype(np.int8)
+    return quantized, scale
+
+
+def dequantize_weights(value, scale=None):
+    """Inverse of quantize_weights(). Returns a float32 weight."""
+    value = value.astype(np.float32)
+    if scale is not None:
+        value *= scale
+    return value
+
+
+def quantize_weight_store(store_path, output_path, dtype="int8", layers=None):
+    """Writes a copy of a weight store with its kernels quantized.
+
+    Only kernels (the weights with 2 or more dimensions) are quantized. The
+    biases and batch normalization parameters are small, and sensitive to
+    rounding, so they are kept at full precision.
+
+    store_path: the float32 weight store to quantize
+    output_path: the directory to write the quantized store to
+    dtype: "int8" or "float16", see quantize_weights()
+    layers: Optional. The names of the layers to quantize. All by default.
+    """
+    store = load_weight_store(store_path)
+    quantized = []
+    for layer_name, weights in store.items():
+        entries = []
+        for weight_name, value in weights:
+            scale = None
+            if value.ndim >= 2 and (layers is None or layer_name in layers):
+                value, scale = quantize_weights(value, dtype)
+            entries.append((weight_name, value, scale))
+        quantized.append((layer_name, entries))
+    write_weight_store(output_path, quantized)
+
+
 ############################################################
 #  Miscellaneous
 ############################################################